@@ -13,8 +13,12 @@ uses KaTeX to generate html from tex.
 __version__ = "v202406.1035"
 
 from markdown_katex.wrapper import tex2html
+from markdown_katex.wrapper import tex2html_many
+from markdown_katex.wrapper import get_stats
 from markdown_katex.wrapper import get_bin_cmd
 from markdown_katex.extension import KatexExtension
+from markdown_katex.aio import tex2html_async
+from markdown_katex.aio import markdown_async
 
 
 def _make_extension(**kwargs) -> KatexExtension:
@@ -100,4 +104,14 @@ f(x) = \int_{-\infty}^\infty
 )
 
 
-__all__ = ['makeExtension', '__version__', 'get_bin_cmd', 'tex2html', 'TEST_FORMULAS']
+__all__ = [
+    'makeExtension',
+    '__version__',
+    'get_bin_cmd',
+    'get_stats',
+    'tex2html',
+    'tex2html_many',
+    'tex2html_async',
+    'markdown_async',
+    'TEST_FORMULAS',
+]
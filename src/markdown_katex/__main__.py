@@ -4,10 +4,20 @@
 #
 # Copyright (c) 2019-2024 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
 # SPDX-License-Identifier: MIT
+import os
 import sys
+import glob
 import json
+import time
 import typing as typ
+import argparse
 import subprocess as sp
+import concurrent.futures
+
+try:
+    from pathlib import Path
+except ImportError:
+    from pathlib2 import Path  # type: ignore
 
 import markdown_katex
 from markdown_katex import html
@@ -51,23 +61,307 @@ def _selftest() -> ExitCode:
     return 0
 
 
+MARKDOWN_SUFFIXES = (".md", ".markdown")
+
+# (source path, output path)
+RenderJob = typ.Tuple[Path, Path]
+
+Formula = typ.Tuple[str, typ.Optional[typ.Dict[str, typ.Any]]]
+
+
+def _iter_markdown_paths(paths: typ.Sequence[str]) -> typ.Iterable[typ.Tuple[Path, Path]]:
+    # yields (path, base_dir), outputs are written relative to base_dir
+    cwd = Path.cwd()
+    for path_arg in paths:
+        path = Path(path_arg)
+        if path.is_dir():
+            for suffix in MARKDOWN_SUFFIXES:
+                for md_path in sorted(path.rglob("*" + suffix)):
+                    yield (md_path, path)
+        elif path.is_file():
+            yield (path, cwd)
+        else:
+            for match in sorted(glob.glob(path_arg, recursive=True)):
+                if Path(match).is_file():
+                    yield (Path(match), cwd)
+
+
+def _output_path(md_path: Path, base_dir: Path, output_dir: typ.Optional[Path]) -> Path:
+    if output_dir is None:
+        return md_path.with_suffix(".html")
+
+    try:
+        rel_path = md_path.resolve().relative_to(base_dir.resolve())
+    except ValueError:
+        rel_path = Path(md_path.name)
+    return (output_dir / rel_path).with_suffix(".html")
+
+
+def _collect_jobs(paths: typ.Sequence[str], output_dir: typ.Optional[Path]) -> typ.List[RenderJob]:
+    jobs: typ.List[RenderJob] = []
+    seen: typ.Set[Path] = set()
+    for md_path, base_dir in _iter_markdown_paths(paths):
+        if md_path.resolve() not in seen:
+            seen.add(md_path.resolve())
+            jobs.append((md_path, _output_path(md_path, base_dir, output_dir)))
+    return jobs
+
+
+def _read_text(path: Path) -> str:
+    with path.open(mode="r", encoding="utf-8") as fobj:
+        return fobj.read()
+
+
+def _collect_formulas(
+    md_paths: typ.Sequence[Path], ext_config: typ.Dict[str, typ.Any]
+) -> typ.List[Formula]:
+    """Find the distinct formulas of all files (with the options of the extension)."""
+    # pylint:disable=import-outside-toplevel  ; lazy import to improve cli responsiveness
+    import markdown
+
+    from markdown_katex import extension
+
+    katex_ext = extension.KatexExtension(**ext_config)
+    preproc   = extension.KatexPreprocessor(markdown.Markdown(), katex_ext)
+
+    formulas: typ.Dict[str, Formula] = {}
+    for md_path in md_paths:
+        for tex, options in preproc.collect(_read_text(md_path).split("\n")):
+            # pylint:disable=protected-access ; same options as used by the extension
+            katex_options = extension._katex_options(options)
+            key = json.dumps([tex, katex_options], sort_keys=True)
+            formulas.setdefault(key, (tex, katex_options))
+    return list(formulas.values())
+
+
+def _render_formulas(formulas: typ.List[Formula], max_workers: int) -> int:
+    """Render formulas into the cache, returns the number of errors."""
+    # pylint:disable=import-outside-toplevel  ; lazy import to improve cli responsiveness
+    from markdown_katex import wrapper
+
+    num_errors = 0
+    for result in wrapper.tex2html_many(formulas, max_workers):
+        if isinstance(result, wrapper.KatexError):
+            num_errors += 1
+            print(f"Error: {result}", file=sys.stderr)
+    return num_errors
+
+
+_MD_CTX: typ.Dict[str, typ.Any] = {}
+
+
+def _convert_file(
+    job: RenderJob, extensions: typ.List[str], ext_config: typ.Dict[str, typ.Any]
+) -> typ.Optional[str]:
+    """Convert one file, returns an error message if it failed."""
+    # pylint:disable=import-outside-toplevel  ; lazy import to improve cli responsiveness
+    import markdown
+
+    from markdown_katex import wrapper
+    from markdown_katex import extension
+
+    md_path, out_path = job
+
+    # the markdown instance is reused for all files of a process
+    md_key = json.dumps([extensions, ext_config], sort_keys=True)
+    md_ctx = _MD_CTX.get(md_key)
+    if md_ctx is None:
+        katex_ext = extension.KatexExtension(**ext_config)
+        md_ctx    = _MD_CTX[md_key] = markdown.Markdown(extensions=extensions + [katex_ext])
+
+    try:
+        html_text = md_ctx.reset().convert(_read_text(md_path))
+    except wrapper.KatexError as ex:
+        return f"{md_path}: {ex}"
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with out_path.open(mode="w", encoding="utf-8") as fobj:
+        fobj.write(html_text)
+    return None
+
+
+def _make_arg_parser(command: str, description: str) -> argparse.ArgumentParser:
+    # arguments shared by the render and warm commands
+    arg_parser = argparse.ArgumentParser(
+        prog=f"python -m markdown_katex {command}", description=description
+    )
+    arg_parser.add_argument("paths", nargs="+", help="Markdown files, globs or directories.")
+    arg_parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1, help="Number of processes."
+    )
+    arg_parser.add_argument(
+        "-k",
+        "--katex-option",
+        action='append',
+        default=[],
+        metavar="NAME[=VALUE]",
+        help="Default option for katex, e.g. -k trust -k max-size=10 (repeatable).",
+    )
+    arg_parser.add_argument(
+        "--no-inline-svg", action='store_true', help="Replace inline <svg> with <img> tags."
+    )
+    arg_parser.add_argument("--cache-dir", help="Directory for cached formulas.")
+    arg_parser.add_argument("--cache-backend", help="Cache backend: 'file' or 'sqlite'.")
+    return arg_parser
+
+
+def _ext_config(opts: argparse.Namespace) -> typ.Dict[str, typ.Any]:
+    ext_config: typ.Dict[str, typ.Any] = {}
+    for katex_option in opts.katex_option:
+        name, sep, value = katex_option.partition("=")
+        ext_config[name.lstrip("-")] = value if sep else True
+
+    if opts.no_inline_svg:
+        ext_config['no_inline_svg'] = True
+    if opts.cache_dir:
+        ext_config['cache_dir'] = opts.cache_dir
+    if opts.cache_backend:
+        ext_config['cache_backend'] = opts.cache_backend
+    return ext_config
+
+
+def _parse_render_args(args: typ.Sequence[str]) -> argparse.Namespace:
+    arg_parser = _make_arg_parser("render", "Convert markdown files to html.")
+    arg_parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="Directory for the html files (default: next to the markdown files).",
+    )
+    arg_parser.add_argument(
+        "-x",
+        "--extension",
+        action='append',
+        default=[],
+        help="Markdown extension to use in addition to markdown_katex (repeatable).",
+    )
+    arg_parser.add_argument(
+        "--no-fonts-css", action='store_true', help="Don't insert the font loading stylesheet."
+    )
+    return arg_parser.parse_args(args)
+
+
+def _render(args: typ.Sequence[str]) -> ExitCode:
+    opts       = _parse_render_args(args)
+    output_dir = Path(opts.output_dir) if opts.output_dir else None
+    jobs       = _collect_jobs(opts.paths, output_dir)
+    if not jobs:
+        print("No markdown files found.", file=sys.stderr)
+        return 1
+
+    ext_config = _ext_config(opts)
+    if opts.no_fonts_css:
+        ext_config['insert_fonts_css'] = False
+
+    t_start = time.time()
+
+    # Formulas that are used in multiple files are only rendered once, after
+    # which the files can be converted from the (shared) persistent cache.
+    formulas = _collect_formulas([md_path for md_path, _ in jobs], ext_config)
+    _render_formulas(formulas, max_workers=opts.jobs)
+
+    if opts.jobs > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=opts.jobs) as pool:
+            futures = [
+                pool.submit(_convert_file, job, opts.extension, ext_config) for job in jobs
+            ]
+            errors = [future.result() for future in futures]
+    else:
+        errors = [_convert_file(job, opts.extension, ext_config) for job in jobs]
+
+    for error in errors:
+        if error:
+            print(f"Error: {error}", file=sys.stderr)
+
+    duration   = max(time.time() - t_start, 1e-6)
+    num_failed = sum(1 for error in errors if error)
+    print(
+        f"Converted {len(jobs) - num_failed} of {len(jobs)} files "
+        + f"with {len(formulas)} distinct formulas in {duration:.2f}s "
+        + f"({len(jobs) / duration:.1f} files/s, {len(formulas) / duration:.1f} formulas/s)"
+    )
+    return 1 if num_failed else 0
+
+
+def _is_cached(formula: Formula) -> bool:
+    # pylint:disable=import-outside-toplevel  ; lazy import to improve cli responsiveness
+    # pylint:disable=protected-access ; the cache lookup of the wrapper is reused
+    from markdown_katex import wrapper
+
+    tex, options = formula
+    try:
+        return wrapper._lookup_cached(wrapper._cmd_digest(tex, options)) is not None
+    except wrapper.KatexError:
+        return True  # a cached failure
+
+
+def _warm_svg2img(formulas: typ.List[Formula]) -> None:
+    # pylint:disable=import-outside-toplevel  ; lazy import to improve cli responsiveness
+    from markdown_katex import wrapper
+    from markdown_katex import extension
+
+    for tex, options in formulas:
+        try:
+            extension.tex2html(tex, dict(options or {}, no_inline_svg=True))
+        except wrapper.KatexError:
+            pass  # already reported
+
+
+def _warm(args: typ.Sequence[str]) -> ExitCode:
+    arg_parser = _make_arg_parser("warm", "Render the formulas of markdown files into the cache.")
+    opts       = arg_parser.parse_args(args)
+    md_paths   = [md_path for md_path, _ in _collect_jobs(opts.paths, output_dir=None)]
+    if not md_paths:
+        print("No markdown files found.", file=sys.stderr)
+        return 1
+
+    t_start  = time.time()
+    formulas = _collect_formulas(md_paths, _ext_config(opts))
+    uncached = [formula for formula in formulas if not _is_cached(formula)]
+
+    num_errors = _render_formulas(uncached, max_workers=opts.jobs)
+    if opts.no_inline_svg:
+        _warm_svg2img(formulas)
+
+    duration = max(time.time() - t_start, 1e-6)
+    print(
+        f"Found {len(formulas)} distinct formulas in {len(md_paths)} files, "
+        + f"{len(formulas) - len(uncached)} were cached, rendered {len(uncached)} "
+        + f"({num_errors} errors) in {duration:.2f}s ({len(uncached) / duration:.1f} formulas/s)"
+    )
+    return 1 if num_errors else 0
+
+
 def main(args: typ.Sequence[str] = sys.argv[1:]) -> ExitCode:
     """Basic wrapper around the katex command.
 
     This is mostly just used for self testing.
     $ python -m markdown_katex
+
+    Convert markdown files to html:
+    $ python -m markdown_katex render docs/ --output-dir build/
+
+    Render all formulas of markdown files into the cache:
+    $ python -m markdown_katex warm docs/
     """
     # pylint:disable=dangerous-default-value ; mypy will catch mutations of args
 
     if "--markdown-katex-selftest" in args:
         return _selftest()
 
+    if args and args[0] == "render":
+        return _render(args[1:])
+
+    if args and args[0] == "warm":
+        return _warm(args[1:])
+
     bin_cmd = markdown_katex.get_bin_cmd()
 
     if "--version" in args or "-V" in args:
         version = markdown_katex.__version__
         bin_str = " ".join(bin_cmd)
         print("markdown-katex version: ", version, f"(using binary: {bin_str})")
+        resolve_time = markdown_katex.wrapper.get_bin_cmd_resolve_time() or 0.0
+        print(f"katex command resolved in {resolve_time * 1000:.1f}ms")
 
     return sp.check_call(bin_cmd + list(args))
 
@@ -0,0 +1,216 @@
+# This file is part of the markdown-katex project
+# https://github.com/mbarkhau/markdown-katex
+#
+# Copyright (c) 2019-2024 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""asyncio API for markdown_katex.
+
+Formulas are rendered either by the worker pool (in the default
+executor of the loop) or with asyncio.create_subprocess_exec, so
+that rendering doesn't block the event loop. Cache lookups and other
+file access also happen in the default executor. The number of
+formulas that are rendered concurrently is limited per event loop.
+"""
+
+# pylint: disable=protected-access ; the private helpers of wrapper are shared
+
+import os
+import asyncio
+import typing as typ
+import weakref
+import functools
+import contextvars
+
+import markdown
+
+from markdown_katex import worker
+from markdown_katex import metrics
+from markdown_katex import wrapper
+from markdown_katex import extension
+
+T = typ.TypeVar('T')
+
+DEFAULT_MAX_CONCURRENCY = os.cpu_count() or 1
+
+_max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+
+_SEMAPHORES: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def set_max_concurrency(max_concurrency: int) -> None:
+    """Limit the number of formulas that are rendered concurrently (per event loop)."""
+    global _max_concurrency
+
+    _max_concurrency = max(1, max_concurrency)
+    _SEMAPHORES.clear()
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    loop      = asyncio.get_running_loop()
+    semaphore = _SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = _SEMAPHORES[loop] = asyncio.Semaphore(_max_concurrency)
+    return semaphore
+
+
+async def _run_blocking(func: typ.Callable[..., T], *args: typ.Any) -> T:
+    # in the default executor, with the metrics and tracing context of the caller
+    loop = asyncio.get_running_loop()
+    ctx  = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(ctx.run, func, *args))
+
+
+async def _communicate_async(
+    proc: asyncio.subprocess.Process, tex: str, input_data: typ.Optional[bytes] = None
+) -> wrapper.BytesPair:
+    wrapper._set_rlimits(proc.pid)
+    try:
+        return await asyncio.wait_for(
+            proc.communicate(input_data), timeout=wrapper.get_render_timeout()
+        )
+    except asyncio.TimeoutError:
+        wrapper._kill(proc)
+        await proc.communicate()
+        raise wrapper._timeout_error(tex) from None
+
+
+async def _write_tex2html_async(
+    cmd_parts: typ.List[str], tex: str, tmp_output_file: wrapper.Path
+) -> None:
+    tmp_input_file = await _run_blocking(wrapper._write_tex_input, tex, tmp_output_file)
+
+    cmd_parts = cmd_parts + ["--input", str(tmp_input_file), "--output", str(tmp_output_file)]
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd_parts,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            **wrapper.POPEN_KWARGS,
+        )
+        stdout, errout = await _communicate_async(proc, tex)
+    except wrapper.KatexTimeoutError:
+        if tmp_output_file.exists():
+            tmp_output_file.unlink()
+        raise
+    finally:
+        await _run_blocking(wrapper._remove_tex_input, tmp_input_file)
+
+    ret_code = proc.returncode
+    assert ret_code is not None
+    if ret_code != 0:
+        raise wrapper._katex_error(tex, ret_code, stdout.decode("utf-8"), errout.decode("utf-8"))
+
+
+async def _pipe_tex2html_async(cmd_parts: typ.List[str], tex: str) -> str:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd_parts,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        **wrapper.POPEN_KWARGS,
+    )
+    stdout, errout = await _communicate_async(proc, tex, tex.encode(wrapper.KATEX_INPUT_ENCODING))
+    ret_code = proc.returncode
+    assert ret_code is not None
+    if ret_code != 0:
+        raise wrapper._katex_error(tex, ret_code, stdout.decode("utf-8"), errout.decode("utf-8"))
+
+    return stdout.decode(wrapper.KATEX_OUTPUT_ENCODING).strip()
+
+
+def _get_pool() -> typ.Optional[worker.WorkerPool]:
+    # resolving the katex command may probe the PATH and run the command
+    return worker.get_pool(wrapper.get_bin_cmd())
+
+
+def _cmd_parts(options: wrapper.MaybeOptions) -> typ.List[str]:
+    return list(wrapper._iter_cmd_parts(options))
+
+
+def _tmp_output_file(digest: str) -> wrapper.Path:
+    wrapper.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    return wrapper._tmp_output_file(digest)
+
+
+def _lookup_cached(tex: str, options: wrapper.MaybeOptions) -> typ.Tuple[str, typ.Optional[str]]:
+    # the digest depends on the version of the katex command
+    digest = wrapper._cmd_digest(tex, options)
+    return (digest, wrapper._lookup_cached(digest))
+
+
+async def _render_tex2html_async(tex: str, options: wrapper.MaybeOptions, digest: str) -> str:
+    pool = await _run_blocking(_get_pool)
+    if pool is not None:
+        try:
+            metrics.inc('worker_renders')
+            html = await _run_blocking(pool.render, tex, options, wrapper.get_render_timeout())
+            return html.strip()
+        except worker.RenderTimeout:
+            raise wrapper._timeout_error(tex) from None
+        except worker.RenderError as ex:
+            raise wrapper.KatexError(f"Error processing '{tex}': {ex}") from ex
+        except worker.WorkerError as ex:
+            wrapper.logger.warning(f"katex worker failed, falling back to katex command: {ex}")
+
+    cmd_parts = await _run_blocking(_cmd_parts, options)
+    metrics.inc('spawns')
+    if wrapper.use_pipes():
+        return await _pipe_tex2html_async(cmd_parts, tex)
+
+    tmp_output_file = await _run_blocking(_tmp_output_file, digest)
+    await _write_tex2html_async(cmd_parts, tex, tmp_output_file)
+    return await _run_blocking(wrapper._read_output_file, tmp_output_file)
+
+
+async def _render_and_store_async(tex: str, options: wrapper.MaybeOptions, digest: str) -> str:
+    # same as wrapper._render_and_store
+    try:
+        with wrapper._render_span(tex):
+            result = await _render_tex2html_async(tex, options, digest)
+    except wrapper.KatexError as ex:
+        await _run_blocking(wrapper._render_failed, digest, ex)
+        raise
+
+    return await _run_blocking(wrapper._store_rendered, digest, options, result)
+
+
+async def tex2html_async(tex: str, options: wrapper.MaybeOptions = None) -> str:
+    """Async version of wrapper.tex2html."""
+    digest, result = await _run_blocking(_lookup_cached, tex, options)
+    if result is not None:
+        return result
+
+    try:
+        async with _get_semaphore():
+            return await _render_and_store_async(tex, options, digest)
+    finally:
+        await _run_blocking(wrapper._cleanup_cache_dir)
+
+
+async def convert_async(md_ctx: markdown.Markdown, text: str) -> str:
+    """Convert text using md_ctx, rendering its formulas without blocking the loop.
+
+    The formulas of the document are rendered first (concurrently),
+    so that md_ctx.convert only has to read them from the cache.
+    """
+    formulas: typ.List[wrapper.Formula] = []
+    for preproc in md_ctx.preprocessors:
+        if isinstance(preproc, extension.KatexPreprocessor):
+            formulas.extend(preproc.collect(text.split("\n")))
+
+    await asyncio.gather(
+        *(
+            tex2html_async(tex, extension._katex_options(options))
+            for tex, options in formulas
+        )
+    )
+    html: str = md_ctx.convert(text)
+    return html
+
+
+async def markdown_async(text: str, **kwargs: typ.Any) -> str:
+    """Async version of markdown.markdown, use with extensions=['markdown_katex']."""
+    md_ctx = markdown.Markdown(**kwargs)
+    return await convert_async(md_ctx, text)
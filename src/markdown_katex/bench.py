@@ -0,0 +1,279 @@
+# This file is part of the markdown-katex project
+# https://github.com/mbarkhau/markdown-katex
+#
+# Copyright (c) 2019-2024 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Benchmarks for the hot paths of markdown_katex.
+
+$ python -m markdown_katex.bench --stub
+$ python -m markdown_katex.bench --formulas 5000 --json > before.json
+
+With --stub, formulas are "rendered" by a trivial function rather than
+by katex, so the benchmarks measure only the code of this package and
+the results are comparable across commits and machines without katex.
+"""
+
+# pylint: disable=protected-access ; the benchmarks measure private functions
+
+import os
+import sys
+import json
+import time
+import html
+import shutil
+import typing as typ
+import argparse
+import tempfile
+import statistics
+import contextlib
+
+try:
+    from pathlib import Path
+except ImportError:
+    from pathlib2 import Path  # type: ignore
+
+import markdown
+
+import markdown_katex
+from markdown_katex import cache
+from markdown_katex import wrapper
+from markdown_katex import extension
+
+DEFAULT_FIXTURE_DIR = Path(__file__).parent.parent.parent / "fixture_data"
+
+STUB_BIN_CMD = ["katex-stub"]
+STUB_VERSION = "0.0.0"
+
+
+def _stub_render_tex2html(tex: str, options: wrapper.MaybeOptions, digest: str) -> str:
+    # pylint: disable=unused-argument ; same signature as wrapper._render_tex2html
+    if tex.count("{") != tex.count("}"):
+        raise wrapper.KatexError(f"Error processing '{tex}': ParseError")
+
+    body = '<span class="katex"><span class="katex-mathml">' + html.escape(tex) + '</span>'
+    if "\\" in tex:
+        body += '<svg width="100%" height="0.3em"><path d="M0 0h10"/></svg>'
+    body += '</span>'
+    if options and options.get('display-mode'):
+        body = '<span class="katex-display">' + body + '</span>'
+    return body
+
+
+def _stub_help_text() -> str:
+    return wrapper.DEFAULT_HELP_TEXT
+
+
+@contextlib.contextmanager
+def _patched(obj: typ.Any, name: str, value: typ.Any) -> typ.Iterator[None]:
+    orig_value = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, orig_value)
+
+
+@contextlib.contextmanager
+def stub_renderer() -> typ.Iterator[None]:
+    """Render formulas without katex (and without starting any process)."""
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(_patched(wrapper, '_render_tex2html', _stub_render_tex2html))
+        stack.enter_context(_patched(wrapper, '_get_cmd_help_text', _stub_help_text))
+        stack.enter_context(_patched(wrapper.worker, 'is_enabled', lambda: False))
+        wrapper.set_bin_cmd(STUB_BIN_CMD)
+        wrapper._KATEX_VERSIONS[tuple(STUB_BIN_CMD)] = STUB_VERSION
+        try:
+            yield
+        finally:
+            wrapper.invalidate_bin_cmd()
+
+
+class BenchResult(typ.NamedTuple):
+
+    name : str
+    items: int
+    times: typ.List[float]
+
+    @property
+    def min(self) -> float:
+        return min(self.times)
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.times)
+
+    def as_dict(self) -> typ.Dict[str, typ.Any]:
+        return {
+            'name'    : self.name,
+            'items'   : self.items,
+            'runs'    : len(self.times),
+            'min'     : self.min,
+            'median'  : self.median,
+            'per_item': self.min / max(1, self.items),
+        }
+
+
+def _bench(
+    name  : str,
+    func  : typ.Callable[[], typ.Any],
+    repeat: int,
+    items : int = 1,
+    setup : typ.Optional[typ.Callable[[], typ.Any]] = None,
+) -> BenchResult:
+    times: typ.List[float] = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t_start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t_start)
+    return BenchResult(name, items, times)
+
+
+def synthetic_document(num_formulas: int) -> str:
+    """A markdown document with num_formulas unique formulas (about 3/4 of them inline)."""
+    paragraphs: typ.List[str] = ["# Synthetic Document"]
+    for i in range((num_formulas + 3) // 4):
+        count  = min(4, num_formulas - i * 4)
+        inline = [f"$`a_{{{i}}} + b`$", f"$`x^{{{i}}}`$", f"$`\\sqrt{{{i}}}`$"][:count]
+        paragraphs.append(f"Paragraph {i} with " + ", ".join(inline) + " and some `code`.")
+        if count == 4:
+            paragraphs.append(f"```math\nf_{{{i}}}(x) = \\int_0^{{{i}}} x^2 \\, dx\n```")
+    return "\n\n".join(paragraphs) + "\n"
+
+
+def _postprocessor_input(out_lines: typ.List[str]) -> str:
+    # roughly what markdown produces from the output of the preprocessor
+    return "\n".join(f"<p>{line}</p>" for line in out_lines if line.strip())
+
+
+def _iter_tex2html_benchmarks(tmp_dir: Path, repeat: int) -> typ.Iterable[BenchResult]:
+    formulas  = markdown_katex.TEST_FORMULAS
+    cold_dirs = (tmp_dir / f"cold_{i}" for i in range(repeat))
+
+    def _cold_cache() -> None:
+        wrapper.configure_cache(cache_dir=next(cold_dirs))
+        cache.MEMORY_CACHE.clear()
+
+    def _render_all() -> None:
+        for formula in formulas:
+            wrapper.tex2html(formula)
+
+    yield _bench("tex2html_cold", _render_all, repeat, len(formulas), setup=_cold_cache)
+    yield _bench(
+        "tex2html_warm_disk", _render_all, repeat, len(formulas), setup=cache.MEMORY_CACHE.clear
+    )
+    yield _bench("tex2html_warm_memory", _render_all, repeat, len(formulas))
+
+
+def _iter_document_benchmarks(num_formulas: int, repeat: int) -> typ.Iterable[BenchResult]:
+    md_ctx   = markdown.Markdown(extensions=[extension.KatexExtension()])
+    preproc  = md_ctx.preprocessors['katex_fenced_code_block']
+    postproc = md_ctx.postprocessors['katex_fenced_code_block']
+
+    lines     = synthetic_document(num_formulas).split("\n")
+    out_lines = preproc.run(lines)  # warm up the cache
+    yield _bench("preprocessor_warm", lambda: preproc.run(lines), repeat, num_formulas)
+
+    text = _postprocessor_input(out_lines)
+    assert len(preproc.state.math_html) == num_formulas
+    yield _bench("postprocessor", lambda: postproc.run(text), repeat, num_formulas)
+
+
+def _iter_svg2img_benchmarks(fixture_dir: Path, repeat: int) -> typ.Iterable[BenchResult]:
+    for fixture_path in sorted(fixture_dir.glob("katex_output*.html")):
+        with fixture_path.open(mode="r", encoding="utf-8") as fobj:
+            katex_output = fobj.read()
+        if "<svg" in katex_output:
+            name = "svg2img_" + fixture_path.stem
+            yield _bench(name, lambda: extension.svg2img(katex_output), repeat)
+
+
+def _clear_parsed_options() -> None:
+    wrapper._PARSED_OPTIONS.clear()
+
+
+def _iter_extension_benchmarks(repeat: int) -> typ.Iterable[BenchResult]:
+    yield _bench(
+        "extension_init", extension.KatexExtension, repeat, setup=_clear_parsed_options
+    )
+    yield _bench(
+        "extension_init_lazy",
+        lambda: extension.KatexExtension(lazy_options=True),
+        repeat,
+        setup=_clear_parsed_options,
+    )
+
+
+def run_benchmarks(
+    num_formulas: int = 2000,
+    repeat      : int = 5,
+    fixture_dir : Path = DEFAULT_FIXTURE_DIR,
+) -> typ.List[BenchResult]:
+    tmp_dir     = Path(tempfile.mkdtemp(prefix="mdkatex_bench_"))
+    prev_config = (wrapper.CACHE_BACKEND, wrapper.CACHE_DIR, wrapper.CACHE_MAX_AGE)
+    try:
+        wrapper.configure_cache(cache_dir=tmp_dir / "warm")
+        results = list(_iter_tex2html_benchmarks(tmp_dir, repeat))
+
+        wrapper.configure_cache(cache_dir=tmp_dir / "warm")
+        results.extend(_iter_document_benchmarks(num_formulas, repeat))
+        results.extend(_iter_svg2img_benchmarks(fixture_dir, repeat))
+        results.extend(_iter_extension_benchmarks(repeat))
+        return results
+    finally:
+        wrapper.configure_cache(*prev_config)
+        shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+
+def _format_results(results: typ.List[BenchResult]) -> str:
+    lines = [f"{'benchmark':<36} {'items':>6} {'min ms':>10} {'median ms':>10} {'us/item':>10}"]
+    for result in results:
+        lines.append(
+            f"{result.name:<36} {result.items:>6} {result.min * 1000:>10.3f} "
+            + f"{result.median * 1000:>10.3f} {result.min * 1e6 / max(1, result.items):>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def _parse_args(args: typ.Sequence[str]) -> argparse.Namespace:
+    arg_parser = argparse.ArgumentParser(prog="python -m markdown_katex.bench")
+    arg_parser.add_argument(
+        "--stub", action='store_true', help="Render formulas with a stub instead of katex."
+    )
+    arg_parser.add_argument(
+        "--formulas", type=int, default=2000, help="Formulas in the synthetic document."
+    )
+    arg_parser.add_argument("--repeat", type=int, default=5, help="Runs of each benchmark.")
+    arg_parser.add_argument("--fixture-dir", default=str(DEFAULT_FIXTURE_DIR))
+    arg_parser.add_argument("--json", action='store_true', help="Write results as json.")
+    return arg_parser.parse_args(args)
+
+
+def main(args: typ.Sequence[str] = sys.argv[1:]) -> int:
+    # pylint:disable=dangerous-default-value ; mypy will catch mutations of args
+    opts = _parse_args(args)
+    with contextlib.ExitStack() as stack:
+        if opts.stub:
+            stack.enter_context(stub_renderer())
+        results = run_benchmarks(
+            num_formulas=opts.formulas,
+            repeat=max(1, opts.repeat),
+            fixture_dir=Path(opts.fixture_dir),
+        )
+
+    if opts.json:
+        meta = {
+            'version'  : markdown_katex.__version__,
+            'stub'     : opts.stub,
+            'python'   : sys.version.split()[0],
+            'cpu_count': os.cpu_count(),
+        }
+        print(json.dumps({'meta': meta, 'results': [r.as_dict() for r in results]}, indent=2))
+    else:
+        print(_format_results(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
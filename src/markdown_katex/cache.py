@@ -0,0 +1,426 @@
+# This file is part of the markdown-katex project
+# https://github.com/mbarkhau/markdown-katex
+#
+# Copyright (c) 2019-2024 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Caches for rendered formulas."""
+
+import os
+import re
+import time
+import typing as typ
+import sqlite3
+import hashlib
+import logging
+import threading
+import contextlib
+import collections
+
+try:
+    from pathlib import Path
+except ImportError:
+    from pathlib2 import Path  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logger.warning(f"Invalid value for {name}, using default: {default}")
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logger.warning(f"Invalid value for {name}, using default: {default}")
+        return default
+
+
+DEFAULT_MEMORY_CACHE_ENTRIES = 10000
+DEFAULT_MEMORY_CACHE_SIZE    = 64 * 1024 * 1024
+
+
+class CacheStats(typ.NamedTuple):
+
+    hits   : int
+    misses : int
+    entries: int
+    size   : int
+
+
+class MemoryCache:
+    """A thread safe LRU cache of rendered html, keyed by the digest of a formula.
+
+    The cache is bounded both by the number of entries and by their
+    total size (in characters, which for KaTeX output is close to bytes).
+    """
+
+    def __init__(
+        self, max_entries: typ.Optional[int] = None, max_size: typ.Optional[int] = None
+    ) -> None:
+        self._lock   : threading.Lock = threading.Lock()
+        self._entries: typ.OrderedDict[str, str] = collections.OrderedDict()
+        self._size   : int = 0
+
+        self.hits  : int = 0
+        self.misses: int = 0
+        self.max_entries = DEFAULT_MEMORY_CACHE_ENTRIES
+        self.max_size    = DEFAULT_MEMORY_CACHE_SIZE
+        self.configure(max_entries, max_size)
+
+    def configure(
+        self, max_entries: typ.Optional[int] = None, max_size: typ.Optional[int] = None
+    ) -> None:
+        """Change the bounds of the cache, a bound of 0 disables the cache."""
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_size is not None:
+                self.max_size = max_size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._entries:
+            if len(self._entries) <= self.max_entries and self._size <= self.max_size:
+                break
+            _, html = self._entries.popitem(last=False)
+            self._size -= len(html)
+
+    def get(self, digest: str) -> typ.Optional[str]:
+        with self._lock:
+            html = self._entries.get(digest)
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(digest)
+            return html
+
+    def put(self, digest: str, html: str) -> None:
+        with self._lock:
+            old_html = self._entries.pop(digest, None)
+            if old_html is not None:
+                self._size -= len(old_html)
+
+            self._entries[digest] = html
+            self._size += len(html)
+            self._evict()
+
+    def purge(self, prefix: str) -> None:
+        """Remove all entries whose html starts with prefix."""
+        with self._lock:
+            for digest, html in list(self._entries.items()):
+                if html.startswith(prefix):
+                    del self._entries[digest]
+                    self._size -= len(html)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits   = 0
+            self.misses = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self.hits, self.misses, len(self._entries), self._size)
+
+
+MEMORY_CACHE = MemoryCache(
+    max_entries=env_int('MDKATEX_MEMORY_CACHE_ENTRIES', DEFAULT_MEMORY_CACHE_ENTRIES),
+    max_size=env_int('MDKATEX_MEMORY_CACHE_SIZE', DEFAULT_MEMORY_CACHE_SIZE),
+)
+
+
+DEFAULT_MAX_AGE          = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES      = 100000
+DEFAULT_MAX_SIZE         = 512 * 1024 * 1024
+DEFAULT_CLEANUP_INTERVAL = 5 * 60
+
+ENCODING = "UTF-8"
+
+
+class CacheStore:
+    """Base class for persistent caches of rendered html.
+
+    Entries are stored under a namespace (e.g. the katex version), so
+    that entries for different versions of katex are never mixed up.
+    Entries which have not been used for max_age seconds are removed,
+    as are the least recently used entries if there are more than
+    max_entries or if they are larger than max_size bytes in total.
+    Scanning the store for such entries is expensive, so unless
+    forced, cleanup is done at most once per cleanup_interval.
+    """
+
+    def __init__(
+        self,
+        namespace       : str = "",
+        max_age         : typ.Optional[int] = None,
+        max_entries     : typ.Optional[int] = None,
+        max_size        : typ.Optional[int] = None,
+        cleanup_interval: typ.Optional[int] = None,
+    ) -> None:
+        env_max_age          = env_int('MDKATEX_CACHE_TTL'             , DEFAULT_MAX_AGE)
+        env_max_entries      = env_int('MDKATEX_CACHE_MAX_ENTRIES'     , DEFAULT_MAX_ENTRIES)
+        env_max_size         = env_int('MDKATEX_CACHE_MAX_SIZE'        , DEFAULT_MAX_SIZE)
+        env_cleanup_interval = env_int('MDKATEX_CACHE_CLEANUP_INTERVAL', DEFAULT_CLEANUP_INTERVAL)
+
+        self.namespace        = namespace
+        self.max_age          = max_age or env_max_age
+        self.max_entries      = max_entries or env_max_entries
+        self.max_size         = max_size or env_max_size
+        self.cleanup_interval = cleanup_interval or env_cleanup_interval
+
+        self._cleanup_lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    def get(self, digest: str) -> typ.Optional[str]:
+        """Get the html for digest and extend its life, None if not cached."""
+        raise NotImplementedError
+
+    def put(self, digest: str, html: str) -> None:
+        raise NotImplementedError
+
+    def purge(self, prefix: str) -> None:
+        """Remove all entries of the namespace whose html starts with prefix."""
+        raise NotImplementedError
+
+    def _cleanup(self, now: float) -> None:
+        raise NotImplementedError
+
+    def cleanup(self, force: bool = False) -> None:
+        now = time.time()
+        with self._cleanup_lock:
+            if not force and now - self._last_cleanup < self.cleanup_interval:
+                return
+            self._last_cleanup = now
+
+        self._cleanup(now)
+
+
+@contextlib.contextmanager
+def atomic_writable_path(final_path: Path) -> typ.Iterator[Path]:
+    nonce    = hashlib.sha1(os.urandom(8)).hexdigest()
+    tmp_path = final_path.parent / (final_path.name + "_tmp_" + nonce)
+    final_path.parent.mkdir(parents=True, exist_ok=True)
+    yield tmp_path
+    tmp_path.rename(final_path)
+
+
+PREFIX_DIR_RE = re.compile(r"^[0-9a-f]{2}$")
+# cache entries and the temporary files of atomic_writable_path
+CACHE_FILE_RE = re.compile(r"^[0-9a-f]{64}\.html(_tmp_[0-9a-f]{40})?$")
+# input/output files of katex, when it is not used with pipes
+TMP_FILE_RE = re.compile(r"^[0-9a-f]{64}_tmp_[0-9a-f]{40}\.(html|tex)$")
+
+
+def _scandir(dir_path: str) -> typ.List[os.DirEntry]:
+    try:
+        return list(os.scandir(dir_path))
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+class FileStore(CacheStore):
+    """One <namespace>/<prefix>/<digest>.html file per entry.
+
+    Files are stored in subdirectories by the prefix of their digest,
+    so that no directory grows too large. Cleanup covers all namespaces,
+    so that entries of previously used katex versions expire too.
+    """
+
+    def __init__(self, cache_dir: Path, **kwargs: typ.Any) -> None:
+        super().__init__(**kwargs)
+        self.cache_dir = cache_dir
+
+    def path(self, digest: str) -> Path:
+        return self.cache_dir / self.namespace / digest[:2] / (digest + ".html")
+
+    def get(self, digest: str) -> typ.Optional[str]:
+        cache_file = self.path(digest)
+        try:
+            # give cached file a life extension (update mtime)
+            os.utime(cache_file)
+            with cache_file.open(mode="r", encoding=ENCODING) as fobj:
+                result: str = fobj.read()
+                return result
+        except FileNotFoundError:
+            return None
+
+    def put(self, digest: str, html: str) -> None:
+        with atomic_writable_path(self.path(digest)) as tmp_path:
+            with tmp_path.open(mode="wb") as fobj:
+                fobj.write(html.encode(ENCODING))
+
+    def purge(self, prefix: str) -> None:
+        prefix_data = prefix.encode(ENCODING)
+        for cache_file in (self.cache_dir / self.namespace).glob("*/*.html"):
+            try:
+                with cache_file.open(mode="rb") as fobj:
+                    is_match = fobj.read(len(prefix_data)) == prefix_data
+                if is_match:
+                    cache_file.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _iter_prefix_dirs(self) -> typ.Iterable[str]:
+        # <cache_dir>/<namespace>/<prefix>, or <cache_dir>/<prefix> without a namespace
+        for entry in _scandir(str(self.cache_dir)):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if PREFIX_DIR_RE.match(entry.name):
+                yield entry.path
+            for sub_entry in _scandir(entry.path):
+                if PREFIX_DIR_RE.match(sub_entry.name) and sub_entry.is_dir(follow_symlinks=False):
+                    yield sub_entry.path
+
+    def _iter_files(self) -> typ.Iterable[os.DirEntry]:
+        # NOTE: The cache_dir may be chosen by the user, so only the files
+        #   written by mdkatex are considered, never anything else.
+        for entry in _scandir(str(self.cache_dir)):
+            if TMP_FILE_RE.match(entry.name) and entry.is_file(follow_symlinks=False):
+                yield entry
+
+        for dir_path in self._iter_prefix_dirs():
+            for entry in _scandir(dir_path):
+                if CACHE_FILE_RE.match(entry.name) and entry.is_file(follow_symlinks=False):
+                    yield entry
+
+    def _cleanup(self, now: float) -> None:
+        min_mtime = now - self.max_age
+        cache_files: typ.List[typ.Tuple[float, int, str]] = []
+        for entry in self._iter_files():
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime > min_mtime:
+                    cache_files.append((stat.st_mtime, stat.st_size, entry.path))
+                else:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass  # concurrent thread deleted file before we did
+
+        total_size = sum(size for _, size, _ in cache_files)
+        num_files  = len(cache_files)
+
+        # evict least recently used (touched) files first
+        for _, size, path in sorted(cache_files):
+            if num_files <= self.max_entries and total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            num_files  -= 1
+            total_size -= size
+
+
+SQLITE_FILENAME = "mdkatex_cache.sqlite3"
+
+# Only update the access time of an entry if it is older than this,
+# so that most cache hits don't have to write to the database.
+SQLITE_ATIME_RESOLUTION = 60 * 60
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    digest    TEXT NOT NULL,
+    html      TEXT NOT NULL,
+    size      INTEGER NOT NULL,
+    atime     REAL NOT NULL,
+    PRIMARY KEY (namespace, digest)
+)
+"""
+
+
+class SQLiteStore(CacheStore):
+    """All entries in a single SQLite database.
+
+    This avoids the churn of many small files, which is slow on network
+    and overlay filesystems. The database uses WAL mode, so multiple
+    processes can read and write concurrently, and is read via mmap.
+    """
+
+    def __init__(self, cache_dir: Path, **kwargs: typ.Any) -> None:
+        super().__init__(**kwargs)
+        self.db_path = cache_dir / SQLITE_FILENAME
+        self._local  = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections may not be shared between threads
+        conn: typ.Optional[sqlite3.Connection] = getattr(self._local, 'conn', None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute(SQLITE_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def get(self, digest: str) -> typ.Optional[str]:
+        conn = self._conn()
+        key  = (self.namespace, digest)
+        sql  = "SELECT html, atime FROM cache WHERE namespace = ? AND digest = ?"
+        row  = conn.execute(sql, key).fetchone()
+        if row is None:
+            return None
+
+        html, atime = row
+        now = time.time()
+        if atime < now - SQLITE_ATIME_RESOLUTION:
+            sql = "UPDATE cache SET atime = ? WHERE namespace = ? AND digest = ?"
+            conn.execute(sql, (now,) + key)
+        return typ.cast(str, html)
+
+    def put(self, digest: str, html: str) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO cache (namespace, digest, html, size, atime) "
+            + "VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, digest, html, len(html.encode(ENCODING)), time.time()),
+        )
+
+    def purge(self, prefix: str) -> None:
+        self._conn().execute(
+            "DELETE FROM cache WHERE namespace = ? AND substr(html, 1, ?) = ?",
+            (self.namespace, len(prefix), prefix),
+        )
+
+    def _cleanup(self, now: float) -> None:
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE atime < ?", (now - self.max_age,))
+
+        num_entries, total_size = conn.execute("SELECT COUNT(*), TOTAL(size) FROM cache").fetchone()
+        if num_entries <= self.max_entries and total_size <= self.max_size:
+            return
+
+        # evict least recently used entries first
+        evict_keys: typ.List[typ.Tuple[str, str]] = []
+        sql = "SELECT namespace, digest, size FROM cache ORDER BY atime"
+        for namespace, digest, size in conn.execute(sql):
+            if num_entries <= self.max_entries and total_size <= self.max_size:
+                break
+            evict_keys.append((namespace, digest))
+            num_entries -= 1
+            total_size  -= size
+
+        conn.executemany("DELETE FROM cache WHERE namespace = ? AND digest = ?", evict_keys)
+
+
+CACHE_BACKENDS: typ.Dict[str, typ.Type[CacheStore]] = {
+    'file'  : FileStore,
+    'sqlite': SQLiteStore,
+}
+
+
+def make_store(backend: str, cache_dir: Path, **kwargs: typ.Any) -> CacheStore:
+    if backend not in CACHE_BACKENDS:
+        valid_backends = ", ".join(CACHE_BACKENDS)
+        raise ValueError(f"Invalid cache backend '{backend}', expected one of: {valid_backends}")
+
+    store_type = CACHE_BACKENDS[backend]
+    return store_type(cache_dir, **kwargs)  # type: ignore[call-arg]
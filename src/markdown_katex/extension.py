@@ -3,17 +3,26 @@
 #
 # Copyright (c) 2019-2024 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
 # SPDX-License-Identifier: MIT
+
+# pylint: disable=protected-access ; the cache of wrapper is shared
+
 import re
 import json
+import types
 import base64
 import typing as typ
 import hashlib
 import logging
+import functools
+import threading
+import concurrent.futures
 
 from markdown.extensions import Extension
 from markdown.preprocessors import Preprocessor
 from markdown.postprocessors import Postprocessor
 
+from markdown_katex import metrics
+from markdown_katex import tracing
 from markdown_katex import wrapper
 from markdown_katex.html import KATEX_STYLES
 
@@ -45,48 +54,87 @@ def make_marker_id(text: str) -> str:
     return hashlib.md5(data).hexdigest()
 
 
+# The same few svgs (stretchy arrows, accents, etc.) are used by
+# many formulas, so each of them only has to be encoded once.
+@functools.lru_cache(maxsize=1024)
+def _svg2img_tag(svg_text: str) -> str:
+    if "xmlns" not in svg_text:
+        svg_text = svg_text.replace("<svg ", "<svg " + SVG_XMLNS)
+    svg_data = svg_text.encode("utf-8")
+    img_b64_data: bytes = base64.standard_b64encode(svg_data)
+    img_b64_text = img_b64_data.decode("utf-8")
+    return B64IMG_TMPL.format(img_text=img_b64_text)
+
+
 def svg2img(html: str) -> str:
     """Converts inline svg elements to images.
 
     This is done as a work around for #75 of WeasyPrint
     https://github.com/Kozea/WeasyPrint/issues/75
     """
-    while True:
-        match = SVG_ELEM_RE.search(html)
-        if match:
-            svg_text = match.group(0)
-            if "xmlns" not in svg_text:
-                svg_text = svg_text.replace("<svg ", "<svg " + SVG_XMLNS)
-            svg_data = svg_text.encode("utf-8")
-            img_b64_data: bytes = base64.standard_b64encode(svg_data)
-            img_b64_text = img_b64_data.decode("utf-8")
-            img_b64_tag  = B64IMG_TMPL.format(img_text=img_b64_text)
-            start, end = match.span()
-            html = html[:start] + img_b64_tag + html[end:]
-        else:
-            break
+    return SVG_ELEM_RE.sub(lambda match: _svg2img_tag(match.group(0)), html)
+
+
+# These are options of the extension, not of the katex-cli program.
+EXTENSION_OPTIONS = (
+    'no_inline_svg',
+    'insert_fonts_css',
+    'max_workers',
+    'executor',
+    'cache_backend',
+    'cache_dir',
+    'cache_ttl',
+    'cache_failure_ttl',
+    'katex_bin',
+    'render_timeout',
+    'dedup_svg',
+    'dedup_formulas',
+    'lazy_options',
+    'log_stats',
+)
+
+
+DefaultOptions = typ.Optional[typ.Mapping[str, wrapper.ArgValue]]
+
+
+def _katex_options(options: DefaultOptions) -> wrapper.MaybeOptions:
+    # a copy, the options of the caller are not modified
+    if options is None:
+        return None
+    else:
+        return {name: val for name, val in options.items() if name not in EXTENSION_OPTIONS}
+
+
+def _img_digest(tex: str, katex_options: wrapper.MaybeOptions) -> str:
+    # the no_inline_svg variant of a formula is cached separately
+    return wrapper._variant_digest(wrapper._cmd_digest(tex, katex_options), "no_inline_svg")
+
 
-    return html
+def _cached_svg2img(img_digest: str, html: str) -> str:
+    with tracing.span("mdkatex.svg2img"):
+        img_html = svg2img(html)
+    wrapper._store_cached(img_digest, img_html)
+    return img_html
 
 
-def tex2html(tex: str, options: wrapper.MaybeOptions = None) -> str:
+def tex2html(tex: str, options: DefaultOptions = None) -> str:
     if options:
         no_inline_svg = options.get("no_inline_svg", False)
     else:
         no_inline_svg = False
 
-    # These are options of the extension, not of the katex-cli program.
-    if options:
-        options.pop('no_inline_svg'   , None)
-        options.pop('insert_fonts_css', None)
+    katex_options = _katex_options(options)
+    if not no_inline_svg:
+        return wrapper.tex2html(tex, katex_options)
 
-    result = wrapper.tex2html(tex, options)
-    if no_inline_svg:
-        result = svg2img(result)
-    return result
+    img_digest = _img_digest(tex, katex_options)
+    img_html   = wrapper._lookup_cached(img_digest)
+    if img_html is None:
+        img_html = _cached_svg2img(img_digest, wrapper.tex2html(tex, katex_options))
+    return img_html
 
 
-def md_block2html(block_text: str, default_options: wrapper.MaybeOptions = None) -> str:
+def _parse_block(block_text: str, default_options: DefaultOptions = None) -> wrapper.Formula:
     options: wrapper.Options = {'display-mode': True}
 
     if default_options:
@@ -98,7 +146,11 @@ def md_block2html(block_text: str, default_options: wrapper.MaybeOptions = None)
         options.update(json.loads(header))
         block_text = rest
 
-    return tex2html(block_text, options)
+    return (block_text, options)
+
+
+def md_block2html(block_text: str, default_options: DefaultOptions = None) -> str:
+    return tex2html(*_parse_block(block_text, default_options))
 
 
 def _clean_inline_text(inline_text: str) -> str:
@@ -113,10 +165,111 @@ def _clean_inline_text(inline_text: str) -> str:
     return inline_text
 
 
-def md_inline2html(inline_text: str, default_options: wrapper.MaybeOptions = None) -> str:
-    options     = default_options.copy() if default_options else {}
+def _parse_inline(inline_text: str, default_options: DefaultOptions = None) -> wrapper.Formula:
+    options     = dict(default_options) if default_options else {}
     inline_text = _clean_inline_text(inline_text)
-    return tex2html(inline_text, options)
+    return (inline_text, options)
+
+
+def md_inline2html(inline_text: str, default_options: DefaultOptions = None) -> str:
+    return tex2html(*_parse_inline(inline_text, default_options))
+
+
+# (bin_cmd, cache_backend, cache_dir, cache_max_age, failure_ttl, render_timeout)
+ProcessConfig = typ.Tuple[typ.List[str], str, str, int, int, typ.Optional[float]]
+
+
+def _process_config() -> ProcessConfig:
+    # Child processes don't inherit the configuration of the parent under
+    # spawn/forkserver, so it is passed along with each formula.
+    return (
+        wrapper.get_bin_cmd(),
+        wrapper.CACHE_BACKEND,
+        str(wrapper.CACHE_DIR),
+        wrapper.CACHE_MAX_AGE,
+        wrapper.CACHE_FAILURE_TTL,
+        wrapper.get_render_timeout(),
+    )
+
+
+def _apply_process_config(config: ProcessConfig) -> None:
+    # cheap if the configuration is unchanged (the pool is reused for many documents)
+    bin_cmd, backend, cache_dir, max_age, failure_ttl, render_timeout = config
+    wrapper.set_bin_cmd(bin_cmd)
+    wrapper.configure_cache(backend, cache_dir, max_age, failure_ttl)
+    wrapper.set_render_timeout(render_timeout)
+
+
+def _tex2html_process(config: ProcessConfig, formula: wrapper.Formula) -> str:
+    _apply_process_config(config)
+    return tex2html(*formula)
+
+
+_PROCESS_POOLS_LOCK = threading.Lock()
+
+# by max_workers, the pools are reused for all documents of this process
+_process_pools: typ.Dict[typ.Optional[int], concurrent.futures.ProcessPoolExecutor] = {}
+
+
+def _get_process_pool(max_workers: typ.Optional[int]) -> concurrent.futures.ProcessPoolExecutor:
+    with _PROCESS_POOLS_LOCK:
+        pool = _process_pools.get(max_workers)
+        if pool is None:
+            pool = _process_pools[max_workers] = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers
+            )
+        return pool
+
+
+def formulas2html(
+    formulas   : typ.Sequence[wrapper.Formula],
+    max_workers: typ.Optional[int] = None,
+    executor   : str = "thread",
+) -> typ.List[str]:
+    """Render formulas concurrently, raising the first error (if any).
+
+    The formulas may have extension options (e.g. no_inline_svg).
+    """
+    if executor not in ("thread", "process"):
+        raise ValueError(f"Invalid executor '{executor}', expected 'thread' or 'process'")
+
+    if executor == "process" and len(formulas) > 1:
+        pool   = _get_process_pool(max_workers)
+        config = _process_config()
+        try:
+            return list(pool.map(functools.partial(_tex2html_process, config), formulas))
+        except concurrent.futures.process.BrokenProcessPool:
+            # e.g. a child was killed, the next document gets a new pool
+            with _PROCESS_POOLS_LOCK:
+                if _process_pools.get(max_workers) is pool:
+                    del _process_pools[max_workers]
+            raise
+
+    html_parts : typ.List[typ.Optional[str]] = []
+    img_digests: typ.Dict[int, str] = {}
+    katex_formulas: typ.List[wrapper.Formula] = []
+    for i, (tex, options) in enumerate(formulas):
+        katex_options = _katex_options(options)
+        katex_formulas.append((tex, katex_options))
+        if options and options.get("no_inline_svg"):
+            img_digests[i] = _img_digest(tex, katex_options)
+            html_parts.append(wrapper._lookup_cached(img_digests[i]))
+        else:
+            html_parts.append(None)
+
+    # only formulas without a cached no_inline_svg variant are rendered
+    render_idxs     = [i for i, html in enumerate(html_parts) if html is None]
+    render_formulas = [katex_formulas[i] for i in render_idxs]
+    for i, result in zip(render_idxs, wrapper.tex2html_many(render_formulas, max_workers)):
+        if isinstance(result, wrapper.KatexError):
+            raise result
+
+        if i in img_digests:
+            html_parts[i] = _cached_svg2img(img_digests[i], result)
+        else:
+            html_parts[i] = result
+
+    return [html for html in html_parts if html is not None]
 
 
 INLINE_DELIM_RE = re.compile(r"`{1,2}")
@@ -158,42 +311,154 @@ def iter_inline_katex(line: str) -> typ.Iterable[InlineCodeItem]:
         yield InlineCodeItem(inline_text, start - 1, end + 2)
 
 
+class ConversionState:
+    """State of the conversion of one document.
+
+    Each Markdown instance has its own state, which is shared by its
+    pre- and postprocessor, so that an extension can be used by many
+    Markdown instances concurrently.
+    """
+
+    def __init__(self) -> None:
+        self.math_html: typ.Dict[str, str] = {}
+        self.metrics  : metrics.Metrics = metrics.Metrics()
+        # timings of the conversion (with MDKATEX_PROFILE)
+        self.profile: typ.Optional[tracing.Profile] = None
+
+    def reset(self) -> None:
+        self.math_html.clear()
+        self.metrics.reset()
+        self.profile = None
+
+
 class KatexExtension(Extension):
     def __init__(self, **kwargs) -> None:
         self.config = {
-            'no_inline_svg'   : ["", "Replace inline <svg> with <img> tags."],
-            'insert_fonts_css': ["", "Insert font loading stylesheet."],
+            'no_inline_svg'    : ["", "Replace inline <svg> with <img> tags."],
+            'insert_fonts_css' : ["", "Insert font loading stylesheet."],
+            'max_workers'      : ["", "Maximum number of formulas rendered concurrently."],
+            'executor'         : ["", "Render using a 'thread' (default) or 'process' pool."],
+            'cache_backend'    : ["", "Cache rendered formulas in 'file's (default) or 'sqlite'."],
+            'cache_dir'        : ["", "Directory for cached formulas (default: $TMP/mdkatex)."],
+            'cache_ttl'        : ["", "Seconds after which unused cached formulas expire."],
+            'cache_failure_ttl': ["", "Seconds for which failed formulas are cached."],
+            'katex_bin'        : ["", "Path to the katex command (default: search PATH)."],
+            'render_timeout'   : ["", "Seconds after which a render is aborted (0: no timeout)."],
+            'dedup_svg'        : ["", "Define repeated svg paths only once per page."],
+            'dedup_formulas'   : ["", "Define repeated formulas only once (requires js)."],
+            'format'           : ["", "Output 'html', 'mathml' or 'htmlAndMathml' (default)."],
+            'minify'           : ["", "Minify the html of formulas (before they are cached)."],
+            'lazy_options'     : ["", "Don't run 'katex --help' to look up the katex options."],
+            'log_stats'        : ["", "Log cache and render stats after each conversion."],
         }
-        for name, options_text in wrapper.parse_options().items():
-            self.config[name] = ["", options_text]
+        # NOTE: The command is shared by all instances in a process and
+        #   it has to be set before its options are parsed.
+        katex_bin = kwargs.get('katex_bin')
+        if katex_bin:
+            wrapper.set_bin_cmd(str(katex_bin))
+
+        if kwargs.get('lazy_options'):
+            # Any unknown option is passed to katex as is, the help texts
+            # of the options are only looked up if they are requested.
+            for name in kwargs:
+                if name not in self.config:
+                    self.config[name] = ["", ""]
+        else:
+            for name, options_text in wrapper.parse_options().items():
+                self.config[name] = ["", options_text]
 
-        self.options: wrapper.Options = {}
+        options: wrapper.Options = {}
         for name in self.config:
             val_configured = self.getConfig(name, "")
             val            = kwargs.get(name, val_configured)
 
             if val != "":
-                self.options[name] = val
-
-        self.math_html: typ.Dict[str, str] = {}
+                options[name] = val
+
+        # NOTE: The options are read only, as they are used by all
+        #   conversions (possibly concurrently).
+        self.options: typ.Mapping[str, wrapper.ArgValue] = types.MappingProxyType(options)
+
+        output_format = self.options.get('format')
+        if output_format and output_format not in wrapper.OUTPUT_FORMATS:
+            raise ValueError(
+                f"Invalid format '{output_format}', expected one of {wrapper.OUTPUT_FORMATS}"
+            )
+
+        cache_option_names = ('cache_backend', 'cache_dir', 'cache_ttl', 'cache_failure_ttl')
+        cache_options      = [self.options.get(name) for name in cache_option_names]
+        if any(option is not None for option in cache_options):
+            # NOTE: The cache is shared by all instances in a process.
+            cache_backend, cache_dir, cache_ttl, cache_failure_ttl = cache_options
+            wrapper.configure_cache(
+                backend=str(cache_backend) if cache_backend else None,
+                cache_dir=str(cache_dir) if cache_dir else None,
+                max_age=int(cache_ttl) if cache_ttl else None,
+                failure_ttl=None if cache_failure_ttl is None else int(cache_failure_ttl),
+            )
+
+        render_timeout = self.options.get('render_timeout')
+        if render_timeout is not None:
+            # NOTE: The timeout is shared by all instances in a process.
+            wrapper.set_render_timeout(float(render_timeout))
+
+        # stats of all conversions by this instance
+        self.metrics: metrics.Metrics = metrics.Metrics()
+        # the state of the last conversion of each thread
+        self._local = threading.local()
         super().__init__(**kwargs)
 
+    @property
+    def state(self) -> ConversionState:
+        state: typ.Optional[ConversionState] = getattr(self._local, 'state', None)
+        if state is None:
+            state = self._local.state = ConversionState()
+        return state
+
+    @state.setter
+    def state(self, state: ConversionState) -> None:
+        self._local.state = state
+
+    @property
+    def math_html(self) -> typ.Dict[str, str]:
+        return self.state.math_html
+
+    @property
+    def conversion_metrics(self) -> metrics.Metrics:
+        return self.state.metrics
+
+    def get_stats(self) -> metrics.Stats:
+        return self.metrics.get_stats()
+
+    def getConfigInfo(self) -> typ.List[typ.Tuple[str, str]]:
+        for name, options_text in wrapper.parse_options().items():
+            if name in self.config and not self.config[name][1]:
+                self.config[name][1] = options_text
+            elif name not in self.config:
+                self.config[name] = ["", options_text]
+        return super().getConfigInfo()
+
     def reset(self) -> None:
-        self.math_html.clear()
+        self.state.reset()
 
     def extendMarkdown(self, md) -> None:
-        preproc = KatexPreprocessor(md, self)
+        state   = ConversionState()
+        preproc = KatexPreprocessor(md, self, state)
         md.preprocessors.register(preproc, name='katex_fenced_code_block', priority=50)
 
-        postproc = KatexPostprocessor(md, self)
+        postproc = KatexPostprocessor(md, self, state)
         md.postprocessors.register(postproc, name='katex_fenced_code_block', priority=0)
         md.registerExtension(self)
 
 
 class KatexPreprocessor(Preprocessor):
-    def __init__(self, md, ext: KatexExtension) -> None:
+    def __init__(
+        self, md, ext: KatexExtension, state: typ.Optional[ConversionState] = None
+    ) -> None:
         super().__init__(md)
-        self.ext: KatexExtension = ext
+        self.ext  : KatexExtension = ext
+        self.state: ConversionState = state or ConversionState()
+        self._pending: typ.Dict[str, wrapper.Formula] = {}
 
     def _make_tag_for_block(self, block_lines: typ.List[str]) -> str:
         indent_len  = len(block_lines[0]) - len(block_lines[0].lstrip())
@@ -203,18 +468,32 @@ class KatexPreprocessor(Preprocessor):
         marker_id  = make_marker_id("block" + block_text)
         marker_tag = f"tmp_block_md_katex_{marker_id}"
 
-        math_html = md_block2html(block_text, self.ext.options)
-        self.ext.math_html[marker_tag] = f"<p>{math_html}</p>"
+        self._pending[marker_tag] = _parse_block(block_text, self.ext.options)
         return indent_text + marker_tag
 
     def _make_tag_for_inline(self, inline_text: str) -> str:
         marker_id  = make_marker_id("inline" + inline_text)
         marker_tag = f"tmp_inline_md_katex_{marker_id}"
 
-        math_html = md_inline2html(inline_text, self.ext.options)
-        self.ext.math_html[marker_tag] = math_html
+        self._pending[marker_tag] = _parse_inline(inline_text, self.ext.options)
         return marker_tag
 
+    def _render_pending(self) -> None:
+        markers  = list(self._pending)
+        formulas = [self._pending[marker_tag] for marker_tag in markers]
+        self._pending.clear()
+
+        options     = self.ext.options
+        max_workers = int(options['max_workers']) if options.get('max_workers') else None
+        executor    = str(options.get('executor') or "thread")
+
+        html_parts = formulas2html(formulas, max_workers=max_workers, executor=executor)
+        for marker_tag, math_html in zip(markers, html_parts):
+            if marker_tag.startswith("tmp_block_md_katex_"):
+                self.state.math_html[marker_tag] = f"<p>{math_html}</p>"
+            else:
+                self.state.math_html[marker_tag] = math_html
+
     def _iter_out_lines(self, lines: typ.List[str]) -> typ.Iterable[str]:
         is_in_math_fence     = False
         is_in_fence          = False
@@ -264,8 +543,33 @@ class KatexPreprocessor(Preprocessor):
             for line in block_lines:
                 yield line
 
+    def collect(self, lines: typ.List[str]) -> typ.List[wrapper.Formula]:
+        """Find the formulas in lines without rendering them."""
+        self._pending.clear()
+        for _ in self._iter_out_lines(lines):
+            pass
+        formulas = list(self._pending.values())
+        self._pending.clear()
+        return formulas
+
     def run(self, lines: typ.List[str]) -> typ.List[str]:
-        return list(self._iter_out_lines(lines))
+        # NOTE: Formulas are only collected while scanning, so that
+        #   they can be rendered concurrently afterwards.
+        self._pending.clear()
+        state = self.state
+        state.reset()
+        self.ext.state = state
+        if tracing.is_profiling_enabled():
+            state.profile = tracing.Profile()
+
+        with tracing.profiling(state.profile):
+            with tracing.span("mdkatex.preprocessor_scan"):
+                out_lines = list(self._iter_out_lines(lines))
+
+            with metrics.collecting(self.ext.metrics, state.metrics):
+                with tracing.span("mdkatex.render_formulas", formulas=len(self._pending)):
+                    self._render_pending()
+        return out_lines
 
 
 # NOTE (mb):
@@ -278,13 +582,185 @@ class KatexPreprocessor(Preprocessor):
 #   valid markdown.
 
 
+# A block marker on its own is wrapped in a paragraph, which is
+# replaced together with the marker (the html has its own <p>).
+MARKER_RE = re.compile(r"(<p>)?(tmp_(block|inline)_md_katex_[0-9a-f]{32})(</p>)?")
+
+
+# The stretchy glyphs of katex (\\widehat, \\overrightarrow, etc.) are
+# svgs with a single large path, which are the same for every formula.
+SVG_PATH_RE = re.compile(r"<path d=(['\"])([^'\"]*)\1\s*(?:/>|></path>)")
+
+SVG_USE_TMPL  = '<use href="#{path_id}"/>'
+SVG_PATH_TMPL = '<path id="{path_id}" d="{path_d}"/>'
+SVG_DEFS_TMPL = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="0" height="0" '
+    + 'style="position:absolute" aria-hidden="true"><defs>{paths}</defs></svg>'
+)
+
+# Formulas which are used more than once are rendered from a <template>
+FORMULA_USE_TMPL      = '<span class="mdkatex-use" data-template="{template_id}"></span>'
+FORMULA_TEMPLATE_TMPL = '<template id="{template_id}">{html}</template>'
+FORMULA_USE_SCRIPT    = (
+    '<script>document.querySelectorAll("span.mdkatex-use").forEach(function (el) {'
+    + 'el.replaceWith(document.getElementById(el.dataset.template).content.cloneNode(true));'
+    + '});</script>'
+)
+MIN_TEMPLATE_SIZE = 200
+
+
+class DedupResult(typ.NamedTuple):
+
+    math_html: typ.Dict[str, str]
+    head     : str
+    tail     : str
+
+
+def _path_id(path_d: str) -> str:
+    # the id only depends on the path, so that multiple conversions on
+    # the same page at worst have identical definitions
+    return "mdkatex-p-" + hashlib.sha1(path_d.encode("utf-8")).hexdigest()[:12]
+
+
+def _repeated_svg_paths(html_counts: typ.Iterable[typ.Tuple[str, int]]) -> typ.Dict[str, str]:
+    path_counts: typ.Dict[str, int] = {}
+    for html, count in html_counts:
+        for match in SVG_PATH_RE.finditer(html):
+            path_d = match.group(2)
+            path_counts[path_d] = path_counts.get(path_d, 0) + count
+
+    path_ids: typ.Dict[str, str] = {}
+    for path_d, count in path_counts.items():
+        path_id  = _path_id(path_d)
+        use_size = len(SVG_USE_TMPL.format(path_id=path_id))
+        def_size = len(SVG_PATH_TMPL.format(path_id=path_id, path_d=path_d))
+        # only paths which are worth the overhead of the reference
+        if count > 1 and count * (len(path_d) - use_size) > def_size:
+            path_ids[path_d] = path_id
+    return path_ids
+
+
+def dedup_math_html(
+    math_html    : typ.Dict[str, str],
+    marker_counts: typ.Dict[str, int],
+    svg_paths    : bool = True,
+    formulas     : bool = False,
+) -> DedupResult:
+    """Deduplicate the html of formulas that are used more than once on a page.
+
+    svg_paths: Paths of svgs are defined once in the head and are
+        referenced using <use>.
+    formulas: Formulas are defined once as a <template>, which is
+        instantiated by the script in the tail.
+    """
+    math_html = dict(math_html)
+    templates: typ.Dict[str, str] = {}
+    if formulas:
+        for marker, count in marker_counts.items():
+            html = math_html.get(marker)
+            if html and count > 1 and len(html) > MIN_TEMPLATE_SIZE:
+                template_id = "mdkatex-f-" + marker.rsplit("_", 1)[-1][:16]
+                templates[template_id] = html
+                math_html[marker]      = FORMULA_USE_TMPL.format(template_id=template_id)
+
+    head = ""
+    if svg_paths:
+        html_counts = [(html, marker_counts.get(marker, 0)) for marker, html in math_html.items()]
+        html_counts.extend((html, 1) for html in templates.values())
+        path_ids = _repeated_svg_paths(html_counts)
+        if path_ids:
+
+            def _use_path(match: typ.Match[str]) -> str:
+                path_id = path_ids.get(match.group(2))
+                if path_id is None:
+                    return match.group(0)
+                else:
+                    return SVG_USE_TMPL.format(path_id=path_id)
+
+            math_html = {key: SVG_PATH_RE.sub(_use_path, html) for key, html in math_html.items()}
+            templates = {key: SVG_PATH_RE.sub(_use_path, html) for key, html in templates.items()}
+            paths     = "".join(
+                SVG_PATH_TMPL.format(path_id=path_id, path_d=path_d)
+                for path_d, path_id in path_ids.items()
+            )
+            head = SVG_DEFS_TMPL.format(paths=paths)
+
+    tail = ""
+    if templates:
+        tail = "".join(
+            FORMULA_TEMPLATE_TMPL.format(template_id=template_id, html=html)
+            for template_id, html in templates.items()
+        )
+        tail += FORMULA_USE_SCRIPT
+
+    return DedupResult(math_html, head, tail)
+
+
 class KatexPostprocessor(Postprocessor):
-    def __init__(self, md, ext: KatexExtension) -> None:
+    def __init__(
+        self, md, ext: KatexExtension, state: typ.Optional[ConversionState] = None
+    ) -> None:
         super().__init__(md)
-        self.ext: KatexExtension = ext
+        self.ext  : KatexExtension = ext
+        self.state: ConversionState = state or ConversionState()
 
     def run(self, text: str) -> str:
-        if any(marker in text for marker in self.ext.math_html):
+        state   = self.state
+        profile = state.profile
+        with tracing.profiling(profile), tracing.span("mdkatex.postprocessor"):
+            text = self._replace_markers(text)
+
+        if profile is not None:
+            formulas = len(state.math_html)
+            tracing.write_report(profile, f"markdown_katex profile of {formulas} formulas")
+            state.profile = None
+
+        if self.ext.options.get('log_stats'):
+            logger.info(f"markdown_katex {state.metrics.summary()}")
+
+        return text
+
+    def _replace_markers(self, text: str) -> str:
+        math_html = self.state.math_html
+        if not math_html:
+            return text
+
+        options = self.ext.options
+        dedup   = None
+        if options.get('dedup_svg') or options.get('dedup_formulas'):
+            marker_counts: typ.Dict[str, int] = {}
+            for match in MARKER_RE.finditer(text):
+                marker_counts[match.group(2)] = marker_counts.get(match.group(2), 0) + 1
+
+            dedup = dedup_math_html(
+                math_html,
+                marker_counts,
+                svg_paths=bool(options.get('dedup_svg')),
+                formulas=bool(options.get('dedup_formulas')),
+            )
+            math_html = dedup.math_html
+
+        found_markers: typ.Set[str] = set()
+
+        def _replace_marker(match: typ.Match[str]) -> str:
+            p_open, marker, kind, p_close = match.groups()
+            html = math_html.get(marker)
+            if html is None:
+                return match.group()
+
+            found_markers.add(marker)
+            if kind == "block" and p_open and p_close:
+                return html
+            else:
+                return (p_open or "") + html + (p_close or "")
+
+        # NOTE: A single scan, rather than a search and replace of the
+        #   whole text for every marker.
+        text = MARKER_RE.sub(_replace_marker, text)
+        if found_markers:
+            if dedup:
+                text = dedup.head + text + dedup.tail
+
             if self.ext.options:
                 insert_fonts_css = self.ext.options.get("insert_fonts_css", True)
             else:
@@ -293,23 +769,8 @@ class KatexPostprocessor(Postprocessor):
             if insert_fonts_css and KATEX_STYLES not in text:
                 text = KATEX_STYLES + text
 
-            for marker, html in self.ext.math_html.items():
-                is_block  = marker.startswith("tmp_block_md_katex_")
-                is_inline = marker.startswith("tmp_inline_md_katex_")
-                assert is_block or is_inline
-
-                if marker in text:
-                    if is_block:
-                        wrapped_marker = "<p>" + marker + "</p>"
-                    else:
-                        wrapped_marker = marker
-
-                    while marker in text:
-                        if wrapped_marker in text:
-                            text = text.replace(wrapped_marker, html)
-                        else:
-                            text = text.replace(marker, html)
-                else:
+            for marker in math_html:
+                if marker not in found_markers:
                     logger.warning(f"KatexPostprocessor couldn't find: {marker}")
 
         return text
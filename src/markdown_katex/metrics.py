@@ -0,0 +1,175 @@
+# This file is part of the markdown-katex project
+# https://github.com/mbarkhau/markdown-katex
+#
+# Copyright (c) 2019-2024 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Counters and latency histograms for rendering and caching.
+
+Everything is recorded in the process wide REGISTRY and additionally
+in any registry that is activated with collecting(), which is how a
+KatexExtension keeps the stats of its own conversions.
+"""
+
+import time
+import typing as typ
+import bisect
+import threading
+import contextlib
+import contextvars
+
+COUNTERS = (
+    'memory_hits',
+    'memory_misses',
+    'disk_hits',
+    'disk_misses',
+    'failure_hits',
+    'renders',
+    'worker_renders',
+    'spawns',
+    'failures',
+    'timeouts',
+    'bytes_read',
+    'bytes_written',
+)
+
+HISTOGRAMS = (
+    'lookup_seconds',
+    'render_seconds',
+)
+
+# upper bounds in seconds, from a memory cache hit to a cold node startup
+DEFAULT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets: typ.Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets: typ.List[float] = sorted(buckets)
+        self.counts : typ.List[int] = [0] * (len(self.buckets) + 1)
+        self.sum    : float = 0.0
+        self.count  : int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def cumulative(self) -> typ.List[typ.Tuple[str, int]]:
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        result: typ.List[typ.Tuple[str, int]] = []
+        total = 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def stats(self) -> typ.Dict[str, typ.Any]:
+        return {
+            'count'  : self.count,
+            'sum'    : self.sum,
+            'mean'   : self.sum / self.count if self.count else 0.0,
+            'buckets': dict(self.cumulative()),
+        }
+
+
+Stats = typ.Dict[str, typ.Any]
+
+
+class Metrics:
+    """A thread safe registry of counters and histograms."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters  : typ.Dict[str, int] = {}
+        self.histograms: typ.Dict[str, Histogram] = {}
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters   = {name: 0 for name in COUNTERS}
+            self.histograms = {name: Histogram() for name in HISTOGRAMS}
+
+    def inc(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def get_stats(self) -> Stats:
+        with self._lock:
+            stats: Stats = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                stats[name] = histogram.stats()
+            return stats
+
+    def summary(self) -> str:
+        stats = self.get_stats()
+        lookups = stats['lookup_seconds']
+        renders = stats['render_seconds']
+        return (
+            f"memory cache: {stats['memory_hits']} hits, {stats['memory_misses']} misses; "
+            + f"disk cache: {stats['disk_hits']} hits, {stats['disk_misses']} misses; "
+            + f"rendered: {stats['renders']} ({stats['spawns']} katex processes, "
+            + f"{stats['worker_renders']} by worker, {stats['failures']} failed, "
+            + f"{stats['timeouts']} timed out) "
+            + f"in {renders['sum']:.3f}s; lookups: {lookups['count']} in {lookups['sum']:.3f}s"
+        )
+
+    def to_prometheus(self, prefix: str = "mdkatex") -> str:
+        """Dump the metrics in the Prometheus text exposition format."""
+        lines: typ.List[str] = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric_name = f"{prefix}_{name}_total"
+                lines.append(f"# TYPE {metric_name} counter")
+                lines.append(f"{metric_name} {value}")
+
+            for name, histogram in sorted(self.histograms.items()):
+                metric_name = f"{prefix}_{name}"
+                lines.append(f"# TYPE {metric_name} histogram")
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{metric_name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f"{metric_name}_sum {histogram.sum}")
+                lines.append(f"{metric_name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Metrics()
+
+_ACTIVE: "contextvars.ContextVar[typ.Tuple[Metrics, ...]]" = contextvars.ContextVar(
+    'mdkatex_metrics', default=()
+)
+
+
+@contextlib.contextmanager
+def collecting(*registries: Metrics) -> typ.Iterator[None]:
+    """Additionally record into registries (in this context)."""
+    token = _ACTIVE.set(_ACTIVE.get() + registries)
+    try:
+        yield
+    finally:
+        _ACTIVE.reset(token)
+
+
+def inc(name: str, value: int = 1) -> None:
+    REGISTRY.inc(name, value)
+    for registry in _ACTIVE.get():
+        registry.inc(name, value)
+
+
+def observe(name: str, value: float) -> None:
+    REGISTRY.observe(name, value)
+    for registry in _ACTIVE.get():
+        registry.observe(name, value)
+
+
+@contextlib.contextmanager
+def timer(name: str) -> typ.Iterator[None]:
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t_start)
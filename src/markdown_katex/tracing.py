@@ -0,0 +1,160 @@
+# This file is part of the markdown-katex project
+# https://github.com/mbarkhau/markdown-katex
+#
+# Copyright (c) 2019-2024 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Tracing spans for the stages of a conversion.
+
+By default spans are not recorded anywhere. Use set_tracer to send
+them to a Tracer, e.g. OpenTelemetryTracer. With MDKATEX_PROFILE=1,
+a timing report of each document is written to stderr (or appended
+to the file MDKATEX_PROFILE=<path>).
+"""
+
+import os
+import sys
+import time
+import typing as typ
+import threading
+import contextlib
+import contextvars
+
+Attributes = typ.Dict[str, typ.Any]
+
+PROFILE_ENV = os.environ.get('MDKATEX_PROFILE', "")
+PROFILE_TOP = int(os.environ.get('MDKATEX_PROFILE_TOP', "10"))
+
+# max length of tex in span attributes and in reports
+MAX_TEX_LEN = 200
+
+
+class Tracer:
+    """A tracer that doesn't record anything.
+
+    Subclasses override span to record spans with their backend.
+    """
+
+    def span(self, name: str, attributes: Attributes) -> typ.ContextManager[typ.Any]:
+        # pylint: disable=unused-argument ; subclasses use the arguments
+        return contextlib.nullcontext()
+
+
+NOOP_TRACER = Tracer()
+
+
+class OpenTelemetryTracer(Tracer):
+    """Records spans using opentelemetry (which must be installed)."""
+
+    def __init__(self, tracer: typ.Any = None) -> None:
+        if tracer is None:
+            from opentelemetry import trace  # pylint: disable=import-outside-toplevel
+
+            tracer = trace.get_tracer("markdown_katex")
+        self._tracer = tracer
+
+    def span(self, name: str, attributes: Attributes) -> typ.ContextManager[typ.Any]:
+        otel_attributes = {
+            "mdkatex." + key: val if isinstance(val, (bool, int, float)) else str(val)
+            for key, val in attributes.items()
+        }
+        return self._tracer.start_as_current_span(name, attributes=otel_attributes)
+
+
+_tracer: Tracer = NOOP_TRACER
+
+
+def set_tracer(tracer: typ.Optional[Tracer]) -> None:
+    """Send spans to tracer (None to disable tracing)."""
+    global _tracer
+
+    _tracer = tracer or NOOP_TRACER
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+class FormulaTiming(typ.NamedTuple):
+
+    seconds: float
+    tex    : str
+
+
+class Profile:
+    """Timings of the spans of one document."""
+
+    def __init__(self, top_n: int = PROFILE_TOP) -> None:
+        self.top_n = top_n
+        self._lock = threading.Lock()
+        # name -> [count, seconds]
+        self.stages  : typ.Dict[str, typ.List[typ.Any]] = {}
+        self.formulas: typ.List[FormulaTiming] = []
+
+    def record(self, name: str, seconds: float, attributes: Attributes) -> None:
+        # formulas of a document are rendered by multiple threads
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+            if 'tex' in attributes:
+                self.formulas.append(FormulaTiming(seconds, attributes['tex']))
+
+    def report(self, title: str = "markdown_katex profile") -> str:
+        lines = [title, f"  {'stage':<28} {'count':>6} {'total ms':>10}"]
+        for name, (count, seconds) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append(f"  {name:<28} {count:>6} {seconds * 1000:>10.3f}")
+
+        if self.formulas:
+            slowest = sorted(self.formulas, reverse=True)[: self.top_n]
+            lines.append(f"  slowest {len(slowest)} of {len(self.formulas)} rendered formulas:")
+            for timing in slowest:
+                tex = " ".join(timing.tex.split())[:MAX_TEX_LEN]
+                lines.append(f"  {timing.seconds * 1000:>10.3f} ms  {tex}")
+        return "\n".join(lines) + "\n"
+
+
+_PROFILE: "contextvars.ContextVar[typ.Optional[Profile]]" = contextvars.ContextVar(
+    'mdkatex_profile', default=None
+)
+
+
+def is_profiling_enabled() -> bool:
+    return PROFILE_ENV not in ("", "0")
+
+
+@contextlib.contextmanager
+def profiling(profile: typ.Optional[Profile]) -> typ.Iterator[None]:
+    """Record the spans (in this context) in profile."""
+    token = _PROFILE.set(profile)
+    try:
+        yield
+    finally:
+        _PROFILE.reset(token)
+
+
+def write_report(profile: Profile, title: str = "markdown_katex profile") -> None:
+    report = profile.report(title)
+    if PROFILE_ENV in ("1", "stderr"):
+        sys.stderr.write(report)
+    else:
+        with open(PROFILE_ENV, mode="a", encoding="utf-8") as fobj:
+            fobj.write(report)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: typ.Any) -> typ.Iterator[None]:
+    profile = _PROFILE.get()
+    if profile is None and _tracer is NOOP_TRACER:
+        yield
+        return
+
+    if 'tex' in attributes:
+        attributes['tex'] = attributes['tex'][:MAX_TEX_LEN]
+
+    t_start = time.perf_counter()
+    try:
+        with _tracer.span(name, attributes):
+            yield
+    finally:
+        if profile is not None:
+            profile.record(name, time.perf_counter() - t_start, attributes)
@@ -0,0 +1,460 @@
+# This file is part of the markdown-katex project
+# https://github.com/mbarkhau/markdown-katex
+#
+# Copyright (c) 2019-2024 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Persistent KaTeX render worker.
+
+Spawning the katex command costs a full node startup for every
+formula. A worker is a single long lived node process that loads
+the katex module once and then renders formulas it receives as
+newline delimited json frames on stdin, writing one json frame per
+response to stdout.
+"""
+
+import os
+import re
+import json
+import atexit
+import shutil
+import typing as typ
+import logging
+import threading
+import contextlib
+import subprocess as sp
+
+try:
+    from pathlib import Path
+except ImportError:
+    from pathlib2 import Path  # type: ignore
+
+from markdown_katex.cache import env_int
+
+logger = logging.getLogger(__name__)
+
+
+# NOTE (mb 2024-07-02): The script is passed via "node -e" so that
+#   we don't have to ship (and locate) an extra file in the package.
+WORKER_SCRIPT = r"""
+const readline = require('readline');
+const katex = require(process.env.MDKATEX_KATEX_MODULE || 'katex');
+
+function send(frame) {
+    process.stdout.write(JSON.stringify(frame) + "\n");
+}
+
+const rl = readline.createInterface({input: process.stdin, terminal: false});
+rl.on('line', function (line) {
+    const req = JSON.parse(line);
+    try {
+        send({id: req.id, html: katex.renderToString(req.tex, req.options)});
+    } catch (err) {
+        send({id: req.id, error: String(err)});
+    }
+});
+
+send({id: 0, ready: true, version: katex.version});
+"""
+
+
+ArgValue  = typ.Union[str, int, float, bool]
+Options   = typ.Dict[str, ArgValue]
+JSOptions = typ.Dict[str, typ.Any]
+
+
+class WorkerError(Exception):
+    """The worker process could not be started or has died."""
+
+
+class RenderError(Exception):
+    """KaTeX reported an error for a formula (the worker is still healthy)."""
+
+
+class RenderTimeout(WorkerError):
+    """A formula took longer than the timeout and the worker was killed."""
+
+
+_NUMBER_RE = re.compile(r"^-?\d+(\.\d+)?$")
+_INT_RE    = re.compile(r"^\s*[+-]?\d+")
+
+# Options the katex cli parses with parseInt, all other numbers with parseFloat.
+# The worker has to convert them the same way, it shares cache entries with the cli.
+INT_OPTIONS = {'max-size', 'max-expand'}
+
+
+def _parse_value(value: ArgValue) -> ArgValue:
+    if isinstance(value, str) and _NUMBER_RE.match(value):
+        return float(value) if "." in value else int(value)
+    else:
+        return value
+
+
+def _parse_int(value: ArgValue) -> ArgValue:
+    # like javascript parseInt: "1.5" -> 1
+    match = _INT_RE.match(value) if isinstance(value, str) else None
+    if match:
+        return int(match.group())
+    elif isinstance(value, float):
+        return int(value)
+    else:
+        return value
+
+
+def _js_name(name: str) -> str:
+    # "max-expand" -> "maxExpand"
+    head, *tail = name.split("-")
+    return head + "".join(part.title() for part in tail)
+
+
+def _parse_macros(macro_lines: typ.Iterable[str]) -> typ.Dict[str, str]:
+    # same parsing as the katex cli: "\name:expansion", lines without a colon are ignored
+    macros: typ.Dict[str, str] = {}
+    for line in macro_lines:
+        name, sep, expansion = line.partition(":")
+        if sep:
+            macros[name.strip()] = expansion.strip()
+    return macros
+
+
+def js_options(options: typ.Optional[Options]) -> JSOptions:
+    """Translate katex cli options to katex.renderToString settings."""
+    result     : JSOptions = {}
+    macro_lines: typ.List[str] = []
+    cli_macros : typ.List[str] = []
+
+    for option_name, option_value in (options or {}).items():
+        name = option_name[2:] if option_name.startswith("--") else option_name
+        if option_value is False:
+            continue
+
+        if name == 'minify':
+            continue  # applied to the output, see wrapper.OUTPUT_OPTIONS
+        elif name == 'no-throw-on-error':
+            result['throwOnError'] = False
+        elif name == 'format':
+            result['output'] = str(option_value)
+        elif name == 'error-color':
+            # the cli prefixes the color, e.g. "cc0000" -> "#cc0000"
+            result['errorColor'] = "#" + str(option_value)
+        elif name in INT_OPTIONS:
+            result[_js_name(name)] = _parse_int(option_value)
+        elif name == 'macro':
+            cli_macros.append(str(option_value))
+        elif name == 'macro-file':
+            with Path(str(option_value)).open(mode="r", encoding="utf-8") as fobj:
+                macro_lines.extend(fobj.read().splitlines())
+        else:
+            result[_js_name(name)] = _parse_value(option_value)
+
+    # macros from the command line override macros from the file
+    macros = _parse_macros(macro_lines + cli_macros)
+    if macros:
+        result['macros'] = macros
+    return result
+
+
+def _find_node() -> typ.Optional[str]:
+    return os.environ.get('MDKATEX_NODE') or shutil.which("node")
+
+
+def find_katex_module(bin_cmd: typ.List[str]) -> typ.Optional[Path]:
+    """Find the directory of the katex node module used by bin_cmd.
+
+    The worker is only used if it loads the exact same katex module
+    as the command, otherwise the output (and the cache entries) of
+    the worker and the command could differ.
+    """
+    env_module = os.environ.get('MDKATEX_KATEX_MODULE')
+    if env_module:
+        return Path(env_module)
+
+    if not bin_cmd:
+        return None
+
+    # npm installs the katex command as a symlink to .../node_modules/katex/cli.js
+    bin_path = Path(bin_cmd[0]).resolve()
+    if bin_path.name == "cli.js" and (bin_path.parent / "package.json").exists():
+        return bin_path.parent
+    else:
+        return None
+
+
+class KatexWorker:
+    """A single node process which renders formulas one at a time."""
+
+    def __init__(self, node: str, module_dir: Path) -> None:
+        # pylint: disable=consider-using-with ; the process outlives this method
+        env = os.environ.copy()
+        env['MDKATEX_KATEX_MODULE'] = str(module_dir)
+
+        self._lock       = threading.Lock()
+        self._next_id    = 1
+        self.num_renders = 0
+        self._proc       = sp.Popen(
+            [node, "-e", WORKER_SCRIPT],
+            stdin=sp.PIPE,
+            stdout=sp.PIPE,
+            stderr=sp.DEVNULL,
+            env=env,
+        )
+        ready = self._read_frame()
+        if not ready.get('ready'):
+            self.close()
+            raise WorkerError(f"Unexpected handshake from katex worker: {ready}")
+
+        self.version: str = ready.get('version', "")
+
+    @property
+    def is_alive(self) -> bool:
+        return self._proc.poll() is None
+
+    def rss(self) -> typ.Optional[int]:
+        """Resident set size of the worker process in bytes (if known)."""
+        status_path = Path("/proc") / str(self._proc.pid) / "status"
+        try:
+            with status_path.open(mode="r", encoding="utf-8") as fobj:
+                for line in fobj:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def _read_frame(self) -> typ.Dict[str, typ.Any]:
+        assert self._proc.stdout is not None
+        line = self._proc.stdout.readline()
+        if not line:
+            self.close()
+            raise WorkerError("katex worker process ended unexpectedly")
+
+        frame: typ.Dict[str, typ.Any] = json.loads(line.decode("utf-8"))
+        return frame
+
+    def _read_response(self, timeout: typ.Optional[float]) -> typ.Dict[str, typ.Any]:
+        if not timeout:
+            return self._read_frame()
+
+        # The worker renders synchronously, so the only way to abort
+        # a render is to kill it, which also ends the blocking read.
+        timed_out = threading.Event()
+
+        def _kill() -> None:
+            timed_out.set()
+            self._proc.kill()
+
+        timer = threading.Timer(timeout, _kill)
+        timer.start()
+        try:
+            return self._read_frame()
+        except WorkerError:
+            if timed_out.is_set():
+                raise RenderTimeout(f"katex worker killed after {timeout}s") from None
+            raise
+        finally:
+            timer.cancel()
+
+    def render(
+        self, tex: str, options: typ.Optional[Options] = None, timeout: typ.Optional[float] = None
+    ) -> str:
+        request: typ.Dict[str, typ.Any] = {'tex': tex, 'options': js_options(options)}
+        with self._lock:
+            request['id'] = self._next_id
+            self._next_id += 1
+
+            assert self._proc.stdin is not None
+            try:
+                self._proc.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+                self._proc.stdin.flush()
+            except OSError as ex:
+                self.close()
+                raise WorkerError("katex worker process ended unexpectedly") from ex
+
+            response = self._read_response(timeout)
+            self.num_renders += 1
+
+        if response.get('id') != request['id']:
+            self.close()
+            raise WorkerError(f"Out of sequence response from katex worker: {response}")
+
+        if 'error' in response:
+            raise RenderError(response['error'])
+
+        html: str = response['html']
+        return html
+
+    def close(self) -> None:
+        for buf in (self._proc.stdin, self._proc.stdout):
+            if buf is not None:
+                try:
+                    buf.close()
+                except OSError:
+                    pass
+
+        if self._proc.poll() is None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=5)
+            except sp.TimeoutExpired:
+                self._proc.kill()
+
+
+DEFAULT_POOL_SIZE   = os.cpu_count() or 1
+DEFAULT_MAX_RENDERS = 10000
+DEFAULT_MAX_RSS     = 512 * 1024 * 1024
+
+
+class WorkerPool:
+    """A bounded pool of workers that can be used by multiple threads.
+
+    Workers are started lazily (up to size) and are replaced after they
+    crash, after max_renders formulas, or when their rss exceeds max_rss.
+    """
+
+    def __init__(
+        self,
+        node       : str,
+        module_dir : Path,
+        size       : typ.Optional[int] = None,
+        max_renders: typ.Optional[int] = None,
+        max_rss    : typ.Optional[int] = None,
+    ) -> None:
+        self.node        = node
+        self.module_dir  = module_dir
+        self.size        = max(1, size or env_int('MDKATEX_WORKERS', DEFAULT_POOL_SIZE))
+        self.max_renders = max_renders or env_int('MDKATEX_WORKER_MAX_RENDERS', DEFAULT_MAX_RENDERS)
+        self.max_rss     = max_rss or env_int('MDKATEX_WORKER_MAX_RSS', DEFAULT_MAX_RSS)
+
+        self.num_started  = 0
+        self.num_recycled = 0
+
+        self._cond   : threading.Condition = threading.Condition()
+        self._idle   : typ.List[KatexWorker] = []
+        self._num_out: int = 0
+        self._closed : bool = False
+
+    def _is_exhausted(self, katex_worker: KatexWorker) -> bool:
+        if not katex_worker.is_alive:
+            return True
+        if katex_worker.num_renders >= self.max_renders:
+            return True
+        rss = katex_worker.rss()
+        return rss is not None and rss > self.max_rss
+
+    def _acquire(self) -> KatexWorker:
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise WorkerError("katex worker pool has been shut down")
+                if self._idle:
+                    self._num_out += 1
+                    return self._idle.pop()
+                if self._num_out < self.size:
+                    self._num_out += 1
+                    break
+                self._cond.wait()
+
+        # start outside of the lock, node startup is slow
+        try:
+            katex_worker = KatexWorker(self.node, self.module_dir)
+        except (OSError, ValueError, WorkerError) as ex:
+            self._release(None)
+            raise WorkerError(f"Could not start katex worker: {ex}") from ex
+
+        with self._cond:
+            self.num_started += 1
+        return katex_worker
+
+    def _release(self, katex_worker: typ.Optional[KatexWorker]) -> None:
+        if katex_worker is not None and self._is_exhausted(katex_worker):
+            katex_worker.close()
+            katex_worker = None
+            with self._cond:
+                self.num_recycled += 1
+
+        with self._cond:
+            self._num_out -= 1
+            if katex_worker is not None:
+                if self._closed:
+                    katex_worker.close()
+                else:
+                    self._idle.append(katex_worker)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def checkout(self) -> typ.Iterator[KatexWorker]:
+        katex_worker = self._acquire()
+        try:
+            yield katex_worker
+        finally:
+            self._release(katex_worker)
+
+    def render(
+        self, tex: str, options: typ.Optional[Options] = None, timeout: typ.Optional[float] = None
+    ) -> str:
+        with self.checkout() as katex_worker:
+            return katex_worker.render(tex, options, timeout)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+
+        for katex_worker in idle:
+            katex_worker.close()
+
+
+_POOL_LOCK = threading.Lock()
+
+# A pool for which no worker could be started is not retried, the value is then False.
+_POOL: typ.Union[None, bool, WorkerPool] = None
+
+
+def is_enabled() -> bool:
+    return os.environ.get('MDKATEX_WORKER', "1").lower() not in ("0", "false", "no", "off")
+
+
+def start_pool(bin_cmd: typ.List[str], size: typ.Optional[int] = None) -> typ.Optional[WorkerPool]:
+    """Start a pool of workers equivalent to bin_cmd, or None if not possible."""
+    node       = _find_node()
+    module_dir = find_katex_module(bin_cmd)
+    if node is None or module_dir is None:
+        return None
+
+    pool = WorkerPool(node, module_dir, size=size)
+    try:
+        # make sure at least one worker can be started
+        with pool.checkout():
+            pass
+    except WorkerError as ex:
+        logger.info(f"Could not start katex worker, using katex command instead: {ex}")
+        pool.close()
+        return None
+
+    return pool
+
+
+def get_pool(bin_cmd: typ.List[str]) -> typ.Optional[WorkerPool]:
+    """Get the shared worker pool for this process (started on first use)."""
+    global _POOL
+
+    if not is_enabled():
+        return None
+
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = start_pool(bin_cmd) or False
+
+        return _POOL if isinstance(_POOL, WorkerPool) else None
+
+
+def shutdown() -> None:
+    global _POOL
+
+    with _POOL_LOCK:
+        if isinstance(_POOL, WorkerPool):
+            _POOL.close()
+        _POOL = None
+
+
+atexit.register(shutdown)
@@ -10,20 +10,38 @@
 
 import os
 import re
+import json
 import time
 import signal
 import typing as typ
 import hashlib
+import logging
 import platform
 import tempfile
+import threading
 import contextlib
+import contextvars
 import subprocess as sp
+import concurrent.futures
+
+try:
+    import resource
+except ImportError:
+    resource = None  # type: ignore
 
 try:
     from pathlib import Path
 except ImportError:
     from pathlib2 import Path  # type: ignore
 
+from markdown_katex import cache
+from markdown_katex import worker
+from markdown_katex import metrics
+from markdown_katex import tracing
+
+
+logger = logging.getLogger(__name__)
+
 
 SIG_NAME_BY_NUM = {
     k: v
@@ -34,7 +52,9 @@ SIG_NAME_BY_NUM = {
 assert SIG_NAME_BY_NUM[15] == 'SIGTERM'
 
 
-CACHE_DIR = Path(tempfile.gettempdir()) / "mdkatex"
+DEFAULT_CACHE_DIR = Path(tempfile.gettempdir()) / "mdkatex"
+
+CACHE_DIR = Path(os.environ.get('MDKATEX_CACHE_DIR') or DEFAULT_CACHE_DIR)
 
 LIBDIR: Path = Path(__file__).parent
 PKG_BIN_DIR      = LIBDIR / "bin"
@@ -55,15 +75,10 @@ KATEX_INPUT_ENCODING  = "UTF-8"
 KATEX_OUTPUT_ENCODING = "UTF-8"
 
 # local cache so we don't have to validate the command every time
-LOCAL_CMD_CACHE = CACHE_DIR / "local_katex_cmd.txt"
+LOCAL_CMD_CACHE = DEFAULT_CACHE_DIR / "local_katex_cmd.txt"
 
 
-@contextlib.contextmanager
-def _atomic_writable_path(final_path: Path):
-    nonce    = hashlib.sha1(os.urandom(8)).hexdigest()
-    tmp_path = final_path.parent / (final_path.name + "_tmp_" + nonce)
-    yield tmp_path
-    tmp_path.rename(final_path)
+_atomic_writable_path = cache.atomic_writable_path
 
 
 def _get_env_paths() -> typ.Iterable[Path]:
@@ -121,7 +136,6 @@ def _get_usr_parts() -> typ.Optional[typ.List[str]]:
             except OSError:
                 continue
 
-            CACHE_DIR.mkdir(parents=True, exist_ok=True)
             local_cmd_data = "\n".join(local_cmd_parts).encode("utf-8")
 
             with _atomic_writable_path(LOCAL_CMD_CACHE) as tmp_path:
@@ -151,7 +165,11 @@ def _get_pkg_bin_path(osname: str = OSNAME, machine: str = MACHINE) -> Path:
     raise NotImplementedError(err_msg)
 
 
-def get_bin_cmd() -> typ.List[str]:
+def _resolve_bin_cmd() -> typ.List[str]:
+    env_bin_cmd = os.environ.get('MDKATEX_KATEX_BIN')
+    if env_bin_cmd:
+        return env_bin_cmd.split()
+
     usr_bin_cmd = _get_usr_parts()
     if usr_bin_cmd is None:
         # use packaged binary
@@ -160,6 +178,71 @@ def get_bin_cmd() -> typ.List[str]:
         return usr_bin_cmd
 
 
+_BIN_CMD_LOCK = threading.Lock()
+
+# The command is resolved once per process (or after invalidate_bin_cmd),
+# as doing so may involve probing every directory of the PATH.
+_bin_cmd: typ.Optional[typ.List[str]] = None
+_bin_cmd_resolve_time: typ.Optional[float] = None
+
+
+def get_bin_cmd() -> typ.List[str]:
+    global _bin_cmd
+    global _bin_cmd_resolve_time
+
+    bin_cmd = _bin_cmd
+    if bin_cmd is None:
+        with _BIN_CMD_LOCK:
+            if _bin_cmd is None:
+                t_start  = time.time()
+                _bin_cmd = _resolve_bin_cmd()
+                _bin_cmd_resolve_time = time.time() - t_start
+                logger.debug(f"Resolved katex command in {_bin_cmd_resolve_time:.3f}s: {_bin_cmd}")
+            bin_cmd = _bin_cmd
+    return list(bin_cmd)
+
+
+def get_bin_cmd_resolve_time() -> typ.Optional[float]:
+    """Seconds it took to resolve the katex command, None if not yet resolved."""
+    return _bin_cmd_resolve_time
+
+
+def invalidate_bin_cmd() -> None:
+    """Resolve the katex command again on next use, e.g. after installing katex."""
+    global _bin_cmd
+    global _bin_cmd_resolve_time
+    global _cache_store
+
+    with _BIN_CMD_LOCK:
+        _bin_cmd = None
+        _bin_cmd_resolve_time = None
+        _PARSED_OPTIONS.clear()
+
+    # the namespace of the cache and the worker depend on the command
+    _cache_store = None
+    worker.shutdown()
+
+
+def set_bin_cmd(bin_cmd: typ.Union[str, Path, typ.List[str]]) -> None:
+    """Pin the katex command, e.g. "/usr/local/bin/katex" or ["npx", "katex"]."""
+    global _bin_cmd
+    global _bin_cmd_resolve_time
+
+    if isinstance(bin_cmd, (str, Path)):
+        bin_cmd_parts = [str(bin_cmd)]
+    else:
+        bin_cmd_parts = list(bin_cmd)
+
+    if bin_cmd_parts == _bin_cmd:
+        # e.g. each KatexExtension(katex_bin=...), the worker pool keeps running
+        return
+
+    invalidate_bin_cmd()
+    with _BIN_CMD_LOCK:
+        _bin_cmd = bin_cmd_parts
+        _bin_cmd_resolve_time = 0.0
+
+
 def _iter_output_lines(buf: typ.IO[bytes]) -> typ.Iterable[bytes]:
     while True:
         output = buf.readline()
@@ -177,79 +260,263 @@ def read_output(buf: typ.Optional[typ.IO[bytes]]) -> str:
 ArgValue     = typ.Union[str, int, float, bool]
 Options      = typ.Dict[str, ArgValue]
 MaybeOptions = typ.Optional[Options]
+BytesPair    = typ.Tuple[bytes, bytes]
 
 
 class KatexError(Exception):
     pass
 
 
+class KatexTimeoutError(KatexError):
+    """Rendering took longer than the render timeout (and katex was killed)."""
+
+
+# A formula (e.g. with a huge --max-expand) may take arbitrarily long,
+# so that renders are killed after RENDER_TIMEOUT seconds (0 to disable).
+DEFAULT_RENDER_TIMEOUT = 30.0
+
+RENDER_TIMEOUT = cache.env_float('MDKATEX_RENDER_TIMEOUT', DEFAULT_RENDER_TIMEOUT)
+
+# Resource limits of each katex process: seconds of cpu time and bytes
+# of address space (0 for no limit). The worker is limited by max_rss.
+RLIMIT_CPU = cache.env_int('MDKATEX_RLIMIT_CPU', 0)
+RLIMIT_AS  = cache.env_int('MDKATEX_RLIMIT_AS', 0)
+
+
+def set_render_timeout(timeout: typ.Optional[float]) -> None:
+    """Kill katex if a formula takes longer than timeout seconds (None or 0 to disable)."""
+    global RENDER_TIMEOUT
+
+    RENDER_TIMEOUT = max(0.0, timeout or 0.0)
+
+
+def get_render_timeout() -> typ.Optional[float]:
+    return RENDER_TIMEOUT or None
+
+
+def _timeout_error(tex: str) -> KatexTimeoutError:
+    return KatexTimeoutError(
+        f"Error processing '{tex}': katex_cli process timed out after {RENDER_TIMEOUT}s"
+    )
+
+
+def _set_rlimits(pid: int) -> None:
+    # NOTE: prlimit is used on the running process, rather than setrlimit
+    #   in a preexec_fn, as preexec_fn is not safe to use with threads.
+    if not (RLIMIT_CPU or RLIMIT_AS) or resource is None or not hasattr(resource, 'prlimit'):
+        return
+
+    try:
+        if RLIMIT_CPU:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (RLIMIT_CPU, RLIMIT_CPU))
+        if RLIMIT_AS:
+            resource.prlimit(pid, resource.RLIMIT_AS, (RLIMIT_AS, RLIMIT_AS))
+    except (OSError, ValueError) as ex:
+        # the process may already have exited
+        logger.debug(f"Could not set resource limits of katex process: {ex}")
+
+
+# The katex command may be a script that starts node, so it has its own
+# process group, which is killed as a whole when a render times out.
+POPEN_KWARGS: typ.Dict[str, typ.Any] = {'start_new_session': True} if os.name == 'posix' else {}
+
+
+def _kill(proc: typ.Any) -> None:
+    # proc is either a Popen or an asyncio Process
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+
+
+def _communicate(proc: sp.Popen, tex: str, input_data: typ.Optional[bytes] = None) -> BytesPair:
+    # communicate reads stdout and stderr concurrently, so that a large
+    # output can't block katex while we wait for it to exit.
+    _set_rlimits(proc.pid)
+    try:
+        stdout, errout = proc.communicate(input_data, timeout=get_render_timeout())
+    except sp.TimeoutExpired:
+        _kill(proc)
+        proc.communicate()
+        raise _timeout_error(tex) from None
+    return stdout, errout
+
+
+# Values of the katex option --format (the output setting of katex)
+OUTPUT_FORMATS        = ("html", "mathml", "htmlAndMathml")
+DEFAULT_OUTPUT_FORMAT = "htmlAndMathml"
+
+# These options are applied to the output of katex, rather than being
+# passed to katex (they are part of the cache key all the same).
+OUTPUT_OPTIONS = ('minify',)
+
+
+def _iter_options_argv(options: Options) -> typ.Iterable[str]:
+    for option_name, option_value in options.items():
+        if option_name.startswith("--"):
+            arg_name = option_name
+        else:
+            arg_name = "--" + option_name
+
+        if arg_name[2:] in OUTPUT_OPTIONS:
+            continue
+        elif option_value is True:
+            yield arg_name
+        elif option_value is False:
+            continue
+        else:
+            arg_value = str(option_value)
+            yield arg_name
+            yield arg_value
+
+
+OptionsKey = typ.Tuple[typ.Tuple[str, type, ArgValue], ...]
+
+# Documents usually use only a handful of different sets of options,
+# so their translation to arguments is done only once for each set.
+_OPTIONS_ARGV: typ.Dict[OptionsKey, typ.List[str]] = {}
+
+MAX_OPTIONS_ARGV = 1000
+
+
+def _options_argv(options: MaybeOptions) -> typ.List[str]:
+    if not options:
+        return []
+
+    # the type is part of the key, as True == 1 but they are different options
+    key  = tuple((name, type(value), value) for name, value in options.items())
+    argv = _OPTIONS_ARGV.get(key)
+    if argv is None:
+        argv = list(_iter_options_argv(options))
+        if len(_OPTIONS_ARGV) >= MAX_OPTIONS_ARGV:
+            _OPTIONS_ARGV.clear()
+        _OPTIONS_ARGV[key] = argv
+    return argv
+
+
 def _iter_cmd_parts(options: MaybeOptions = None) -> typ.Iterable[str]:
     for cmd_part in get_bin_cmd():
         yield cmd_part
 
-    if options:
-        for option_name, option_value in options.items():
-            if option_name.startswith("--"):
-                arg_name = option_name
-            else:
-                arg_name = "--" + option_name
+    for cmd_part in _options_argv(options):
+        yield cmd_part
 
-            if option_value is True:
-                yield arg_name
-            elif option_value is False:
-                continue
-            else:
-                arg_value = str(option_value)
-                yield arg_name
-                yield arg_value
 
+# Runs of whitespace are a single space for the KaTeX lexer, except
+# that a newline ends a % comment. This doesn't apply to \verb.
+WHITESPACE_RE      = re.compile(r"[ \t\r\n]+")
+TRAILING_SPACE_RE  = re.compile(r"(?<!\\)[ \t\r\n]+$")
+UNNORMALIZABLE_TEX = ("\\verb",)
 
-def _cmd_digest(tex: str, cmd_parts: typ.List[str]) -> str:
-    hasher = hashlib.sha256(tex.encode("utf-8"))
-    for cmd_part in cmd_parts:
-        hasher.update(cmd_part.encode("utf-8"))
-    return hasher.hexdigest()
 
+def _canonical_tex(tex: str) -> str:
+    if any(token in tex for token in UNNORMALIZABLE_TEX):
+        return tex
 
-def _write_tex2html(cmd_parts: typ.List[str], tex: str, tmp_output_file: Path) -> None:
-    # pylint: disable=consider-using-with ; not supported on py27
-    tmp_input_file = CACHE_DIR / tmp_output_file.name.replace(".html", ".tex")
+    tex = TRAILING_SPACE_RE.sub("", tex.lstrip())
+    return WHITESPACE_RE.sub(lambda match: "\n" if "\n" in match.group() else " ", tex)
+
+
+_MACRO_FILE_DIGESTS: typ.Dict[typ.Tuple[str, int, int], str] = {}
+
+
+def _macro_file_digest(path: str) -> str:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return "missing:" + path
+
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _MACRO_FILE_DIGESTS:
+        with open(path, mode="rb") as fobj:
+            _MACRO_FILE_DIGESTS[key] = hashlib.sha256(fobj.read()).hexdigest()
+    return _MACRO_FILE_DIGESTS[key]
+
+
+def _canonical_options(options: MaybeOptions) -> typ.List[typ.Tuple[str, str]]:
+    canonical: typ.List[typ.Tuple[str, str]] = []
+    for option_name, option_value in (options or {}).items():
+        if option_value is False:
+            continue  # same as if the option was not set
+
+        name  = option_name[2:] if option_name.startswith("--") else option_name
+        value = "" if option_value is True else str(option_value)
+        if name == 'format' and value == DEFAULT_OUTPUT_FORMAT:
+            continue  # same as if the option was not set
+        if name == 'macro-file':
+            # the contents matter, not where the file happens to be
+            value = _macro_file_digest(value)
+        canonical.append((name, value))
+    return sorted(canonical)
+
+
+def _cmd_digest(tex: str, options: MaybeOptions = None) -> str:
+    """Cache key for the output of katex for tex with options.
+
+    The key only depends on what affects the output, so that equivalent
+    renders on different machines share the same entry: the katex
+    version rather than the path of the binary, options in sorted order,
+    the contents of a macro-file rather than its path and tex with
+    normalized whitespace.
+    """
+    key_data = {
+        'version': get_katex_version(),
+        'tex'    : _canonical_tex(tex),
+        'options': _canonical_options(options),
+    }
+    key_text = json.dumps(key_data, sort_keys=True)
+    return hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+
+
+STYLE_ATTR_RE     = re.compile(r' style="([^"]*)"')
+LEADING_ZERO_RE   = re.compile(r"(?<![\w.])0\.(?=\d)")
+TAG_WHITESPACE_RE = re.compile(r">\s*\n\s*<")
+
+
+def _minify_style(match: typ.Match[str]) -> str:
+    style = LEADING_ZERO_RE.sub(".", match.group(1)).strip().rstrip(";")
+    return f' style="{style}"' if style else ""
+
+
+def minify_html(html: str) -> str:
+    """Remove redundant characters from the html of katex.
+
+    Only line breaks between tags (not spaces, which may be part of
+    the math), empty styles, trailing semicolons in styles and leading
+    zeros of numbers in styles are removed, so the rendering is the same.
+    """
+    html = TAG_WHITESPACE_RE.sub("><", html)
+    return STYLE_ATTR_RE.sub(_minify_style, html)
+
+
+def _katex_error(tex: str, ret_code: int, stdout: str = "", errout: str = "") -> KatexError:
+    if ret_code < 0:
+        signame = SIG_NAME_BY_NUM[abs(ret_code)]
+        err_msg = (
+            f"Error processing '{tex}': "
+            + "katex_cli process ended with "
+            + f"code {ret_code} ({signame})"
+        )
+    else:
+        output  = (stdout + "\n" + errout).strip()
+        err_msg = f"Error processing '{tex}': {output}"
+    return KatexError(err_msg)
+
+
+def _write_tex_input(tex: str, tmp_output_file: Path) -> Path:
+    tmp_input_file = tmp_output_file.parent / tmp_output_file.name.replace(".html", ".tex")
     input_data     = tex.encode(KATEX_INPUT_ENCODING)
 
-    CACHE_DIR.mkdir(parents=True, exist_ok=True)
     with _atomic_writable_path(tmp_input_file) as tmp_path:
         with tmp_path.open(mode="wb") as fobj:
             fobj.write(input_data)
+    return tmp_input_file
 
-    cmd_parts.extend(["--input", str(tmp_input_file), "--output", str(tmp_output_file)])
-    proc = None
-    try:
-        proc     = sp.Popen(cmd_parts, stdout=sp.PIPE, stderr=sp.PIPE)
-        ret_code = proc.wait()
-        if ret_code < 0:
-            signame = SIG_NAME_BY_NUM[abs(ret_code)]
-            err_msg = (
-                f"Error processing '{tex}': "
-                + "katex_cli process ended with "
-                + f"code {ret_code} ({signame})"
-            )
-            raise KatexError(err_msg)
-        elif ret_code > 0:
-            stdout  = read_output(proc.stdout)
-            errout  = read_output(proc.stderr)
-            output  = (stdout + "\n" + errout).strip()
-            err_msg = f"Error processing '{tex}': {output}"
-            raise KatexError(err_msg)
-    finally:
-        if proc is not None:
-            # It might be reasonable that Popen itself raises an
-            # exception. In such a case, proc would still be None
-            # and there is nothing to close.
-            if proc.stdout is not None:
-                proc.stdout.close()
-            if proc.stderr is not None:
-                proc.stderr.close()
 
+def _remove_tex_input(tmp_input_file: Path) -> None:
     try:
         tmp_input_file.unlink()
     except FileNotFoundError:
@@ -260,41 +527,383 @@ def _write_tex2html(cmd_parts: typ.List[str], tex: str, tmp_output_file: Path) -
         pass
 
 
-def tex2html(tex: str, options: MaybeOptions = None) -> str:
-    cmd_parts         = list(_iter_cmd_parts(options))
-    digest            = _cmd_digest(tex, cmd_parts)
-    cache_filename    = digest + ".html"
-    cache_output_file = CACHE_DIR / cache_filename
+def _write_tex2html(cmd_parts: typ.List[str], tex: str, tmp_output_file: Path) -> None:
+    tmp_input_file = _write_tex_input(tex, tmp_output_file)
 
+    cmd_parts.extend(["--input", str(tmp_input_file), "--output", str(tmp_output_file)])
     try:
-        if cache_output_file.exists():
-            # give cached file a life extension (update mtime)
-            cache_output_file.touch()
-        else:
-            with _atomic_writable_path(cache_output_file) as tmp_output_file:
-                _write_tex2html(cmd_parts, tex, tmp_output_file)
+        proc = sp.Popen(cmd_parts, stdout=sp.PIPE, stderr=sp.PIPE, **POPEN_KWARGS)
+        with proc:
+            stdout, errout = _communicate(proc, tex)
+    except KatexTimeoutError:
+        if tmp_output_file.exists():
+            tmp_output_file.unlink()
+        raise
+    finally:
+        _remove_tex_input(tmp_input_file)
+
+    if proc.returncode < 0:
+        raise _katex_error(tex, proc.returncode)
+    elif proc.returncode > 0:
+        raise _katex_error(tex, proc.returncode, stdout.decode("utf-8"), errout.decode("utf-8"))
+
+
+def _pipe_tex2html(cmd_parts: typ.List[str], tex: str) -> str:
+    # Without --input/--output, katex reads from stdin and writes to stdout.
+    proc = sp.Popen(cmd_parts, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, **POPEN_KWARGS)
+    with proc:
+        stdout, errout = _communicate(proc, tex, tex.encode(KATEX_INPUT_ENCODING))
+
+    if proc.returncode < 0:
+        raise _katex_error(tex, proc.returncode)
+    elif proc.returncode > 0:
+        raise _katex_error(tex, proc.returncode, stdout.decode("utf-8"), errout.decode("utf-8"))
+
+    return stdout.decode(KATEX_OUTPUT_ENCODING).strip()
+
 
-        with cache_output_file.open(mode="r", encoding=KATEX_OUTPUT_ENCODING) as fobj:
+def use_pipes() -> bool:
+    """Pass formulas to katex via stdin/stdout rather than temporary files."""
+    return os.environ.get('MDKATEX_PIPES', "1").lower() not in ("0", "false", "no", "off")
+
+
+def _tmp_output_file(digest: str) -> Path:
+    nonce = hashlib.sha1(os.urandom(8)).hexdigest()
+    return CACHE_DIR / f"{digest}_tmp_{nonce}.html"
+
+
+def _read_output_file(tmp_output_file: Path) -> str:
+    try:
+        with tmp_output_file.open(mode="r", encoding=KATEX_OUTPUT_ENCODING) as fobj:
             result: str = fobj.read()
             return result.strip()
+    finally:
+        tmp_output_file.unlink()
+
+
+def _variant_digest(digest: str, variant: str) -> str:
+    # a digest for output derived from the output of digest
+    return hashlib.sha256(f"{digest}:{variant}".encode("utf-8")).hexdigest()
+
+
+def _render_tex2html(tex: str, options: MaybeOptions, digest: str) -> str:
+    pool = worker.get_pool(get_bin_cmd())
+    if pool is not None:
+        try:
+            metrics.inc('worker_renders')
+            return pool.render(tex, options, timeout=get_render_timeout()).strip()
+        except worker.RenderTimeout:
+            raise _timeout_error(tex) from None
+        except worker.RenderError as ex:
+            raise KatexError(f"Error processing '{tex}': {ex}") from ex
+        except worker.WorkerError as ex:
+            logger.warning(f"katex worker failed, falling back to katex command: {ex}")
+
+    cmd_parts = list(_iter_cmd_parts(options))
+    metrics.inc('spawns')
+    if use_pipes():
+        return _pipe_tex2html(cmd_parts, tex)
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_output_file = _tmp_output_file(digest)
+    _write_tex2html(cmd_parts, tex, tmp_output_file)
+    return _read_output_file(tmp_output_file)
+
+
+_KATEX_VERSIONS: typ.Dict[typ.Tuple[str, ...], str] = {}
+
+KATEX_VERSION_RE = re.compile(r"v?(\d+\.\d+\.\d+)")
+
+
+def _static_katex_version(bin_cmd: typ.List[str]) -> typ.Optional[str]:
+    # the version of the command, if it can be determined without running it
+
+    # packaged binaries are named like: katex_v0.15.1_node10_x86_64-Linux
+    bin_name = Path(bin_cmd[0]).name
+    if bin_name.startswith("katex_v"):
+        match = KATEX_VERSION_RE.search(bin_name)
+        if match:
+            return match.group(1)
+
+    # npm installs have a package.json next to cli.js
+    module_dir = worker.find_katex_module(bin_cmd)
+    if module_dir:
+        try:
+            with (module_dir / "package.json").open(mode="r", encoding="utf-8") as fobj:
+                version = json.load(fobj).get('version')
+            if isinstance(version, str):
+                return version
+        except (OSError, ValueError):
+            pass
+
+    return None
+
+
+def get_katex_version() -> str:
+    """The version of the katex command (determined once per process)."""
+    bin_cmd = get_bin_cmd()
+    key     = tuple(bin_cmd)
+    if key in _KATEX_VERSIONS:
+        return _KATEX_VERSIONS[key]
+
+    version = _static_katex_version(bin_cmd)
+    if version is None:
+        try:
+            output_data = sp.check_output(bin_cmd + ['--version'], stderr=sp.STDOUT)
+            match       = KATEX_VERSION_RE.search(output_data.decode("utf-8"))
+        except (sp.CalledProcessError, OSError):
+            match = None
+        version = match.group(1) if match else "unknown"
+
+    _KATEX_VERSIONS[key] = version
+    return version
+
+
+# Formulas which katex failed to render are cached too, so that a
+# broken formula doesn't start katex again on every build. Failures
+# expire sooner, as they may depend on the environment (e.g. trust).
+DEFAULT_FAILURE_TTL = 10 * 60
+FAILURE_PREFIX      = "!mdkatex_failure:"
+
+CACHE_BACKEND     = os.environ.get('MDKATEX_CACHE_BACKEND', "file")
+CACHE_MAX_AGE     = cache.env_int('MDKATEX_CACHE_TTL', cache.DEFAULT_MAX_AGE)
+CACHE_FAILURE_TTL = cache.env_int('MDKATEX_CACHE_FAILURE_TTL', DEFAULT_FAILURE_TTL)
+
+_cache_store: typ.Optional[cache.CacheStore] = None
+
+
+def _make_cache_store(backend: str, cache_dir: Path, max_age: int) -> cache.CacheStore:
+    # Entries are namespaced by katex version, so that a persistent cache
+    # directory can be reused safely after katex has been upgraded.
+    namespace = "katex_" + get_katex_version()
+    return cache.make_store(backend, cache_dir, namespace=namespace, max_age=max_age)
+
+
+def get_cache_store() -> cache.CacheStore:
+    global _cache_store
+
+    if _cache_store is None:
+        _cache_store = _make_cache_store(CACHE_BACKEND, CACHE_DIR, CACHE_MAX_AGE)
+    return _cache_store
+
+
+def configure_cache(
+    backend    : typ.Optional[str] = None,
+    cache_dir  : typ.Union[None, str, Path] = None,
+    max_age    : typ.Optional[int] = None,
+    failure_ttl: typ.Optional[int] = None,
+) -> None:
+    """Configure the persistent cache of this process.
+
+    backend: "file" (default) or "sqlite"
+    cache_dir: directory for the cache (default: $TMP/mdkatex)
+    max_age: entries which haven't been used for this many seconds expire
+    failure_ttl: seconds for which failures are cached (0 to disable)
+    """
+    global CACHE_BACKEND
+    global CACHE_DIR
+    global CACHE_MAX_AGE
+    global CACHE_FAILURE_TTL
+    global _cache_store
+
+    new_backend   = backend or CACHE_BACKEND
+    new_cache_dir = Path(cache_dir) if cache_dir else CACHE_DIR
+    new_max_age   = max_age or CACHE_MAX_AGE
+
+    new_config = (new_backend, new_cache_dir, new_max_age)
+    # Keep the store if nothing changed, a new one would scan the cache on its first cleanup.
+    if new_config != (CACHE_BACKEND, CACHE_DIR, CACHE_MAX_AGE):
+        # make the store first, so an invalid configuration doesn't change anything
+        _cache_store  = _make_cache_store(new_backend, new_cache_dir, new_max_age)
+        CACHE_BACKEND = new_backend
+        CACHE_DIR     = new_cache_dir
+        CACHE_MAX_AGE = new_max_age
+
+    if failure_ttl is not None:
+        CACHE_FAILURE_TTL = failure_ttl
+
+
+def set_cache_backend(backend: str) -> None:
+    """Select the persistent cache for this process, either "file" or "sqlite"."""
+    configure_cache(backend=backend)
+
+
+def _check_failure(result: str) -> typ.Optional[str]:
+    # raise the error of a cached failure, None if it has expired
+    if not result.startswith(FAILURE_PREFIX):
+        return result
+
+    expires, _, message = result[len(FAILURE_PREFIX) :].partition("\n")
+    if float(expires) < time.time():
+        return None
+    else:
+        raise KatexError(message)
+
+
+def _lookup_cached(digest: str) -> typ.Optional[str]:
+    with tracing.span("mdkatex.cache_lookup"), metrics.timer('lookup_seconds'):
+        result = cache.MEMORY_CACHE.get(digest)
+        if result is None:
+            metrics.inc('memory_misses')
+            result = get_cache_store().get(digest)
+            if result is None:
+                metrics.inc('disk_misses')
+                return None
+
+            metrics.inc('disk_hits')
+            metrics.inc('bytes_read', len(result.encode(cache.ENCODING)))
+            result = result.strip()
+            cache.MEMORY_CACHE.put(digest, result)
+        else:
+            metrics.inc('memory_hits')
+
+    if result.startswith(FAILURE_PREFIX):
+        metrics.inc('failure_hits')
+    return _check_failure(result)
+
+
+def _store_cached(digest: str, result: str) -> None:
+    get_cache_store().put(digest, result)
+    metrics.inc('bytes_written', len(result.encode(cache.ENCODING)))
+    cache.MEMORY_CACHE.put(digest, result)
+
+
+def _store_failure(digest: str, err: KatexError) -> None:
+    if CACHE_FAILURE_TTL > 0:
+        expires = time.time() + CACHE_FAILURE_TTL
+        _store_cached(digest, f"{FAILURE_PREFIX}{expires:.0f}\n{err}")
+
+
+def purge_failures() -> None:
+    """Remove all cached failures, so that the formulas are rendered again."""
+    cache.MEMORY_CACHE.purge(FAILURE_PREFIX)
+    get_cache_store().purge(FAILURE_PREFIX)
+
+
+@contextlib.contextmanager
+def _render_span(tex: str) -> typ.Iterator[None]:
+    metrics.inc('renders')
+    with tracing.span("mdkatex.katex_render", tex=tex), metrics.timer('render_seconds'):
+        yield
+
+
+def _render_failed(digest: str, err: KatexError) -> None:
+    if isinstance(err, KatexTimeoutError):
+        # a timeout may not happen again (e.g. on a less busy machine)
+        metrics.inc('timeouts')
+    else:
+        metrics.inc('failures')
+        _store_failure(digest, err)
+
+
+def _store_rendered(digest: str, options: MaybeOptions, result: str) -> str:
+    if options and options.get('minify'):
+        result = minify_html(result)
+    _store_cached(digest, result)
+    return result
+
+
+def _render_and_store(tex: str, options: MaybeOptions, digest: str) -> str:
+    # NOTE: aio.tex2html_async does the same, with the blocking parts in an executor
+    try:
+        with _render_span(tex):
+            result = _render_tex2html(tex, options, digest)
+    except KatexError as ex:
+        _render_failed(digest, ex)
+        raise
+
+    return _store_rendered(digest, options, result)
+
+
+def tex2html(tex: str, options: MaybeOptions = None) -> str:
+    digest = _cmd_digest(tex, options)
+
+    # warm renders don't touch the filesystem (beyond the cache lookup)
+    result = _lookup_cached(digest)
+    if result is not None:
+        return result
+
+    try:
+        return _render_and_store(tex, options, digest)
     finally:
         _cleanup_cache_dir()
 
 
-def _cleanup_cache_dir() -> None:
-    min_mtime = time.time() - 24 * 60 * 60
-    for fpath in CACHE_DIR.iterdir():
+Formula     = typ.Tuple[str, MaybeOptions]
+ManyResults = typ.List[typ.Union[str, KatexError]]
+
+
+def _default_max_workers() -> int:
+    pool = worker.get_pool(get_bin_cmd())
+    if pool is None:
+        return os.cpu_count() or 1
+    else:
+        return pool.size
+
+
+def tex2html_many(
+    formulas: typ.Sequence[Formula], max_workers: typ.Optional[int] = None
+) -> ManyResults:
+    """Render many formulas, each with its own options.
+
+    Formulas are deduplicated and only those that are not cached
+    already are rendered (concurrently). Rather than raising, a
+    formula that could not be rendered has a KatexError as its result.
+    """
+    digests: typ.List[str] = []
+    pending: typ.Dict[str, Formula] = {}
+    results: typ.Dict[str, typ.Union[str, KatexError]] = {}
+
+    for tex, options in formulas:
+        digest = _cmd_digest(tex, options)
+        digests.append(digest)
+        if digest in pending or digest in results:
+            continue
+
         try:
-            if not fpath.is_file():
-                continue
+            result = _lookup_cached(digest)
+        except KatexError as err:
+            results[digest] = err  # cached failure
+            continue
+
+        if result is None:
+            pending[digest] = (tex, options)
+        else:
+            results[digest] = result
+
+    def _render(digest: str) -> typ.Union[str, KatexError]:
+        tex, options = pending[digest]
+        try:
+            return _render_and_store(tex, options, digest)
+        except KatexError as err:
+            return err
+
+    try:
+        if len(pending) > 1:
+            max_workers = min(len(pending), max_workers or _default_max_workers())
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # each render gets a copy of the context, for the active metrics
+                futures = [
+                    executor.submit(contextvars.copy_context().run, _render, digest)
+                    for digest in pending
+                ]
+                results.update(zip(pending, (future.result() for future in futures)))
+        else:
+            results.update((digest, _render(digest)) for digest in pending)
+    finally:
+        _cleanup_cache_dir()
+
+    return [results[digest] for digest in digests]
+
+
+def get_stats() -> metrics.Stats:
+    """Cache hits/misses, renders, failures and latencies of this process."""
+    return metrics.REGISTRY.get_stats()
 
-            mtime = fpath.stat().st_mtime
-            if mtime > min_mtime:
-                continue
 
-            fpath.unlink()
-        except FileNotFoundError:
-            pass  # concurrent thread deleted file before we did
+def _cleanup_cache_dir(force: bool = False) -> None:
+    with tracing.span("mdkatex.cache_cleanup"):
+        get_cache_store().cleanup(force=force)
 
 
 # NOTE: in order to not have to update the code
@@ -371,6 +980,61 @@ def _parse_options_help_text(help_text: str) -> OptionsHelp:
     return options
 
 
+def _options_cache_path(bin_cmd: typ.List[str]) -> typ.Optional[Path]:
+    # The parsed options are cached on disk, so that new processes don't
+    # have to run "katex --help". The key changes if katex is upgraded.
+    try:
+        bin_path = Path(bin_cmd[0]).resolve()
+        stat     = bin_path.stat()
+    except OSError:
+        return None
+
+    key_parts = bin_cmd + [
+        str(bin_path),
+        str(stat.st_mtime_ns),
+        str(stat.st_size),
+        _static_katex_version(bin_cmd) or "",
+    ]
+    key_digest = hashlib.sha256("\n".join(key_parts).encode("utf-8")).hexdigest()
+    return DEFAULT_CACHE_DIR / f"katex_options_{key_digest[:16]}.json"
+
+
+def _read_cached_options(cache_path: Path) -> typ.Optional[OptionsHelp]:
+    try:
+        with cache_path.open(mode="r", encoding="utf-8") as fobj:
+            options = json.load(fobj)
+    except (OSError, ValueError):
+        return None
+
+    if isinstance(options, dict) and all(isinstance(val, str) for val in options.values()):
+        return options
+    else:
+        return None
+
+
+def _write_cached_options(cache_path: Path, options: OptionsHelp) -> None:
+    try:
+        with _atomic_writable_path(cache_path) as tmp_path:
+            with tmp_path.open(mode="w", encoding="utf-8") as fobj:
+                json.dump(options, fobj)
+    except OSError as ex:
+        logger.warning(f"Could not cache katex options: {ex}")
+
+
+def _get_cmd_options() -> OptionsHelp:
+    bin_cmd    = get_bin_cmd()
+    cache_path = _options_cache_path(bin_cmd)
+    if cache_path:
+        cached_options = _read_cached_options(cache_path)
+        if cached_options is not None:
+            return cached_options
+
+    cmd_options = _parse_options_help_text(_get_cmd_help_text())
+    if cache_path and cmd_options:
+        _write_cached_options(cache_path, cmd_options)
+    return cmd_options
+
+
 _PARSED_OPTIONS: OptionsHelp = {}
 
 
@@ -380,9 +1044,7 @@ def parse_options() -> OptionsHelp:
 
     options = _parse_options_help_text(DEFAULT_HELP_TEXT)
     try:
-        help_text   = _get_cmd_help_text()
-        cmd_options = _parse_options_help_text(help_text)
-        options.update(cmd_options)
+        options.update(_get_cmd_options())
     except NotImplementedError:
         # NOTE: no need to fail just for the options
         pass
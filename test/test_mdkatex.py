@@ -17,9 +17,14 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import io
+import json
+import os
 import re
+import time
+import asyncio
 import tempfile
 import textwrap
+import concurrent.futures
 from xml.etree.ElementTree import XML
 
 import bs4
@@ -162,6 +167,230 @@ def test_tex2html():
         assert html_text.endswith("</span>")
 
 
+def test_tex2html_many():
+    invalid_tex = r"e^{2 \pi i \xi x"
+    formulas    = [(formula, None) for formula in markdown_katex.TEST_FORMULAS]
+    formulas.append((BASIC_TEX_TXT, {'display-mode': True}))
+    formulas.append((invalid_tex, None))
+    formulas.append((BASIC_TEX_TXT, None))
+    formulas.append((BASIC_TEX_TXT, {'display-mode': True}))
+
+    results = markdown_katex.tex2html_many(formulas)
+    assert len(results) == len(formulas)
+
+    for (tex, options), result in zip(formulas, results):
+        if tex == invalid_tex:
+            assert isinstance(result, wrp.KatexError)
+            assert "ParseError: KaTeX parse error:" in result.args[0]
+        else:
+            assert result == markdown_katex.tex2html(tex, options)
+
+    assert results[-1].startswith('<span class="katex-display"')
+    assert results[-2].startswith('<span class="katex"')
+
+
+def test_memory_cache():
+    mem_cache = markdown_katex.cache.MemoryCache(max_entries=3, max_size=100)
+    mem_cache.put("a", "x" * 10)
+    mem_cache.put("b", "x" * 10)
+    mem_cache.put("c", "x" * 10)
+    assert mem_cache.get("a") == "x" * 10
+    mem_cache.put("d", "x" * 10)
+
+    # "b" was the least recently used entry
+    assert mem_cache.get("b") is None
+    assert mem_cache.get("a") is not None
+    assert mem_cache.stats() == (2, 1, 3, 30)
+
+    mem_cache.put("e", "x" * 80)
+    assert mem_cache.stats().size <= 100
+    assert mem_cache.get("e") is not None
+
+    mem_cache.configure(max_entries=0)
+    assert mem_cache.stats().entries == 0
+
+    html_data = markdown_katex.tex2html(BASIC_TEX_TXT)
+    hits      = markdown_katex.cache.MEMORY_CACHE.hits
+    assert markdown_katex.tex2html(BASIC_TEX_TXT) == html_data
+    assert markdown_katex.cache.MEMORY_CACHE.hits == hits + 1
+
+
+@pytest.mark.parametrize("backend", ["file", "sqlite"])
+def test_cache_cleanup(tmpdir, backend):
+    now   = time.time()
+    store = markdown_katex.cache.make_store(backend, pl.Path(str(tmpdir)))
+    store.max_entries = 3
+
+    for i in range(5):
+        store.put("{0:02d}".format(i) * 32, "<span>{0}</span>".format(i))
+
+    expired_digest = "ff" * 32
+    store.put(expired_digest, "<span></span>")
+
+    if backend == "file":
+        cache_file = store.path("00" * 32)
+        assert cache_file.parent.name == "00"
+        for i in range(5):
+            age = i * 60
+            os.utime(str(store.path("{0:02d}".format(i) * 32)), (now - age, now - age))
+        age = 2 * store.max_age
+        os.utime(str(store.path(expired_digest)), (now - age, now - age))
+    else:
+        conn = store._conn()
+        sql  = "UPDATE cache SET atime = ? WHERE digest = ?"
+        for i in range(5):
+            conn.execute(sql, (now - i * 60, "{0:02d}".format(i) * 32))
+        conn.execute(sql, (now - 2 * store.max_age, expired_digest))
+
+    assert store.get("04" * 32) == "<span>4</span>"
+
+    store.cleanup(force=True)
+    assert store.get(expired_digest) is None
+    remaining = [i for i in range(5) if store.get("{0:02d}".format(i) * 32)]
+    assert len(remaining) == 3
+    assert 0 in remaining
+    assert 3 not in remaining
+
+    # not forced, so this is skipped within the cleanup interval
+    store.put(expired_digest, "<span></span>")
+    store.max_entries = 0
+    store.cleanup()
+    assert store.get(expired_digest) == "<span></span>"
+
+
+def test_file_cache_cleanup_keeps_other_files(tmpdir):
+    cache_dir = pl.Path(str(tmpdir))
+    store     = markdown_katex.cache.make_store('file', cache_dir, namespace="katex_0.0.0")
+    store.put("ab" * 32, "<span>x</span>")
+
+    old_time   = time.time() - 2 * store.max_age
+    user_paths = [
+        cache_dir / "README.txt",
+        cache_dir / "src" / "notes.md",
+        cache_dir / "katex_0.0.0" / "ab" / "notes.html",
+        cache_dir / "ab" / ("cd" * 32 + ".txt"),
+    ]
+    tmp_paths = [
+        cache_dir / ("ef" * 32 + "_tmp_" + "0" * 40 + ".tex"),
+        cache_dir / "katex_0.0.0" / "ab" / ("ab" * 32 + ".html_tmp_" + "1" * 40),
+    ]
+    for path in user_paths + tmp_paths + [store.path("ab" * 32)]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("x", encoding="utf-8")
+        os.utime(str(path), (old_time, old_time))
+
+    store.max_entries = 0
+    store.cleanup(force=True)
+    assert all(path.exists() for path in user_paths)
+    assert not any(path.exists() for path in tmp_paths)
+    assert not store.path("ab" * 32).exists()
+
+
+@pytest.mark.parametrize("backend", ["file", "sqlite"])
+def test_cache_config(tmpdir, backend):
+    cache_dir = pl.Path(str(tmpdir))
+    prev_config = (wrp.CACHE_BACKEND, wrp.CACHE_DIR, wrp.CACHE_MAX_AGE)
+    markdown_katex.cache.MEMORY_CACHE.clear()
+    try:
+        wrp.configure_cache(backend=backend, cache_dir=cache_dir, max_age=3600)
+        store = wrp.get_cache_store()
+        assert store.max_age == 3600
+
+        # an unchanged configuration keeps the store (and its last cleanup)
+        ext.KatexExtension(cache_backend=backend, cache_dir=str(cache_dir), cache_ttl=3600)
+        wrp.configure_cache(cache_dir=str(cache_dir), failure_ttl=wrp.CACHE_FAILURE_TTL)
+        assert wrp.get_cache_store() is store
+        assert store.namespace == "katex_" + wrp.get_katex_version()
+
+        html_data = markdown_katex.tex2html(BASIC_TEX_TXT)
+        markdown_katex.cache.MEMORY_CACHE.clear()
+        assert markdown_katex.tex2html(BASIC_TEX_TXT) == html_data
+
+        html_files = list(cache_dir.glob(store.namespace + "/*/*.html"))
+        db_file    = cache_dir / markdown_katex.cache.SQLITE_FILENAME
+        if backend == "file":
+            assert len(html_files) == 1
+            assert not db_file.exists()
+        else:
+            assert len(html_files) == 0
+            assert db_file.exists()
+
+        with pytest.raises(ValueError):
+            wrp.configure_cache(backend="invalid")
+        assert wrp.CACHE_BACKEND == backend
+    finally:
+        markdown_katex.cache.MEMORY_CACHE.clear()
+        wrp.configure_cache(*prev_config)
+
+
+def test_cache_key(tmpdir):
+    options = {'display-mode': True, 'trust': True}
+    digest  = wrp._cmd_digest(r"a + b \quad c", options)
+    spaced_tex = " a  +\tb \\quad  c\n"
+    assert digest == wrp._cmd_digest(spaced_tex, {'--trust': True, 'display-mode': True})
+    assert digest == wrp._cmd_digest(r"a + b \quad c", dict(reversed(options.items()), x=False))
+    assert digest != wrp._cmd_digest(r"a + b \quad c", {'display-mode': True})
+    assert digest != wrp._cmd_digest(r"a+b \quad c", {'display-mode': True, 'trust': True})
+
+    # a newline ends a comment, a trailing "\ " is a space
+    assert wrp._cmd_digest("a % b\nc") != wrp._cmd_digest("a % b c")
+    assert wrp._cmd_digest("a\\ ") != wrp._cmd_digest("a\\")
+    assert wrp._cmd_digest(r"\verb|a  b|") != wrp._cmd_digest(r"\verb|a b|")
+
+    macro_file_a = pl.Path(str(tmpdir)) / "a" / "macros.tex"
+    macro_file_b = pl.Path(str(tmpdir)) / "b" / "macros.tex"
+    for macro_file in (macro_file_a, macro_file_b):
+        macro_file.parent.mkdir()
+        macro_file.write_text("\\RR:\\mathbb{R}\n", encoding="utf-8")
+
+    digest_a = wrp._cmd_digest(r"\RR", {'macro-file': str(macro_file_a)})
+    digest_b = wrp._cmd_digest(r"\RR", {'macro-file': str(macro_file_b)})
+    assert digest_a == digest_b
+
+    macro_file_b.write_text("\\RR:\\mathbf{R}\n", encoding="utf-8")
+    os.utime(str(macro_file_b), ns=(0, 0))
+    assert digest_a != wrp._cmd_digest(r"\RR", {'macro-file': str(macro_file_b)})
+
+
+@pytest.mark.parametrize("backend", ["file", "sqlite"])
+def test_failure_cache(tmpdir, monkeypatch, backend):
+    invalid_tex = r"e^{2 \pi i \xi x"
+    render_args = []
+    render_orig = wrp._render_tex2html
+
+    def _render_tex2html(*args):
+        render_args.append(args)
+        return render_orig(*args)
+
+    monkeypatch.setattr(wrp, '_render_tex2html', _render_tex2html)
+
+    prev_config = (wrp.CACHE_BACKEND, wrp.CACHE_DIR, wrp.CACHE_MAX_AGE, wrp.CACHE_FAILURE_TTL)
+    markdown_katex.cache.MEMORY_CACHE.clear()
+    try:
+        wrp.configure_cache(backend=backend, cache_dir=pl.Path(str(tmpdir)), failure_ttl=600)
+        for _ in range(3):
+            with pytest.raises(wrp.KatexError, match="ParseError"):
+                markdown_katex.tex2html(invalid_tex)
+            markdown_katex.cache.MEMORY_CACHE.clear()
+        assert len(render_args) == 1
+
+        wrp.purge_failures()
+        with pytest.raises(wrp.KatexError, match="ParseError"):
+            markdown_katex.tex2html(invalid_tex)
+        assert len(render_args) == 2
+
+        # failures are not cached if the ttl is 0
+        wrp.configure_cache(failure_ttl=0)
+        wrp.purge_failures()
+        for expected_renders in (3, 4):
+            with pytest.raises(wrp.KatexError, match="ParseError"):
+                markdown_katex.tex2html(invalid_tex)
+            assert len(render_args) == expected_renders
+    finally:
+        markdown_katex.cache.MEMORY_CACHE.clear()
+        wrp.configure_cache(*prev_config)
+
+
 def test_basic_block():
     html_data = markdown_katex.tex2html(BASIC_TEX_TXT)
 
@@ -366,6 +595,88 @@ def test_bin_paths():
     assert str(wrp._get_pkg_bin_path(machine="AMD64", osname="Windows")).endswith(".exe")
 
 
+def test_bin_cmd_memoized(monkeypatch):
+    num_calls = []
+    bin_cmd   = wrp.get_bin_cmd()
+
+    def _resolve_bin_cmd():
+        num_calls.append(1)
+        return list(bin_cmd)
+
+    monkeypatch.setattr(wrp, '_resolve_bin_cmd', _resolve_bin_cmd)
+    try:
+        wrp.invalidate_bin_cmd()
+        assert wrp.get_bin_cmd_resolve_time() is None
+        for _ in range(3):
+            assert wrp.get_bin_cmd() == bin_cmd
+        assert len(num_calls) == 1
+        assert wrp.get_bin_cmd_resolve_time() >= 0
+
+        wrp.set_bin_cmd("/path/to/katex")
+        assert wrp.get_bin_cmd() == ["/path/to/katex"]
+        assert len(num_calls) == 1
+
+        # pinning the same command again doesn't shut down the worker pool
+        shutdown_calls = []
+        monkeypatch.setattr(wrp.worker, 'shutdown', lambda: shutdown_calls.append(1))
+        for _ in range(3):
+            ext.KatexExtension(katex_bin="/path/to/katex", lazy_options=True)
+        assert shutdown_calls == []
+        wrp.set_bin_cmd(["/path/to/other/katex"])
+        assert shutdown_calls == [1]
+        wrp.set_bin_cmd("/path/to/katex")
+
+        options = {'display-mode': True, 'trust': False, 'max-size': 10}
+        expected = ["/path/to/katex", "--display-mode", "--max-size", "10"]
+        assert list(wrp._iter_cmd_parts(options)) == expected
+        assert list(wrp._iter_cmd_parts(options)) == expected
+        assert list(wrp._iter_cmd_parts({'max-size': True})) == ["/path/to/katex", "--max-size"]
+    finally:
+        wrp.invalidate_bin_cmd()
+
+
+def test_options_cache(monkeypatch):
+    help_calls = []
+    help_orig  = wrp._get_cmd_help_text
+
+    def _get_cmd_help_text():
+        help_calls.append(1)
+        return help_orig()
+
+    monkeypatch.setattr(wrp, '_get_cmd_help_text', _get_cmd_help_text)
+
+    cache_path = wrp._options_cache_path(wrp.get_bin_cmd())
+    if cache_path.exists():
+        cache_path.unlink()
+
+    options = dict(wrp.parse_options())
+    try:
+        for _ in range(3):
+            wrp._PARSED_OPTIONS.clear()
+            assert wrp.parse_options() == options
+        assert len(help_calls) == 1
+        assert cache_path.exists()
+    finally:
+        wrp._PARSED_OPTIONS.update(options)
+
+
+def test_lazy_options(monkeypatch):
+    def _parse_options():
+        raise AssertionError("options should not be parsed")
+
+    monkeypatch.setattr(wrp, 'parse_options', _parse_options)
+    katex_ext = ext.KatexExtension(lazy_options=True, **{'no-throw-on-error': True})
+    assert katex_ext.options['no-throw-on-error'] is True
+
+    result = md.markdown(BASIC_BLOCK_TXT, extensions=[katex_ext])
+    assert '<span class="katex-display"' in result
+
+    monkeypatch.undo()
+    config_info = dict(katex_ext.getConfigInfo())
+    assert config_info['no-throw-on-error']
+    assert 'macro-file' in config_info
+
+
 def test_html_output():
     # NOTE: This generates html that is to be tested
     #   in the browser (for warnings in devtools).
@@ -590,3 +901,559 @@ def test_paragraph_for_inline_equation():
     )
 
     assert result.count("<p><span") == 2
+
+
+def test_pipe_rendering(tmpdir):
+    for formula in markdown_katex.TEST_FORMULAS:
+        cmd_parts = list(wrp._iter_cmd_parts({'display-mode': True}))
+        tmp_path  = pl.Path(str(tmpdir)) / "pipe_test.html"
+        wrp._write_tex2html(list(cmd_parts), formula, tmp_path)
+        file_output = wrp._read_output_file(tmp_path)
+        pipe_output = wrp._pipe_tex2html(cmd_parts, formula)
+        assert pipe_output == file_output
+
+    assert list(pl.Path(str(tmpdir)).iterdir()) == []
+
+    with pytest.raises(wrp.KatexError, match="ParseError"):
+        wrp._pipe_tex2html(list(wrp._iter_cmd_parts()), r"e^{2 \pi i \xi x")
+
+
+def test_worker_js_options():
+    options = {
+        'display-mode'      : True,
+        'no-throw-on-error' : True,
+        'leqno'             : False,
+        'max-expand'        : "100",
+        'min-rule-thickness': "0.05",
+        'macro'             : "\\RR:\\mathbb{R}",
+    }
+    js_options = wrp.worker.js_options(options)
+    assert js_options == {
+        'displayMode'     : True,
+        'throwOnError'    : False,
+        'maxExpand'       : 100,
+        'minRuleThickness': 0.05,
+        'macros'          : {"\\RR": "\\mathbb{R}"},
+    }
+
+    # same conversions as the katex cli (parseInt, "#" + color)
+    js_options = wrp.worker.js_options(
+        {'error-color': "000000", 'max-size': "10.5", 'max-expand': "1000"}
+    )
+    assert js_options == {'errorColor': "#000000", 'maxSize': 10, 'maxExpand': 1000}
+    assert wrp.worker.js_options({'--error-color': "cc0000"}) == {'errorColor': "#cc0000"}
+
+
+def test_worker_equivalence():
+    pool = wrp.worker.get_pool(wrp.get_bin_cmd())
+    if pool is None:
+        pytest.skip("katex worker not available (requires node and a katex module)")
+
+    for formula in markdown_katex.TEST_FORMULAS:
+        cmd_parts = list(wrp._iter_cmd_parts({'display-mode': True}))
+        with wrp._atomic_writable_path(wrp.CACHE_DIR / "test_worker.html") as tmp_path:
+            wrp._write_tex2html(cmd_parts, formula, tmp_path)
+
+        with (wrp.CACHE_DIR / "test_worker.html").open(mode="r", encoding="utf-8") as fobj:
+            cmd_output = fobj.read().strip()
+
+        worker_output = pool.render(formula, {'display-mode': True})
+        assert worker_output == cmd_output
+
+
+def test_worker_pool_recycling():
+    pool = wrp.worker.start_pool(wrp.get_bin_cmd(), size=2)
+    if pool is None:
+        pytest.skip("katex worker not available (requires node and a katex module)")
+
+    pool.max_renders = 3
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(pool.render, markdown_katex.TEST_FORMULAS * 3))
+    finally:
+        pool.close()
+
+    assert all(result.startswith('<span class="katex"') for result in results)
+    num_formulas = len(markdown_katex.TEST_FORMULAS)
+    assert results[:num_formulas] == results[-num_formulas:]
+    assert pool.num_recycled > 0
+    assert pool.num_started <= pool.num_recycled + 2
+
+
+def test_concurrent_rendering():
+    md_text = "\n\n".join(
+        ["$`{0}`$\n\n```math\n{0}\n```".format(formula) for formula in markdown_katex.TEST_FORMULAS]
+    )
+    expected = md.markdown(
+        md_text,
+        extensions=['markdown_katex'],
+        extension_configs={'markdown_katex': {'max_workers': 1}},
+    )
+    assert "md_katex" not in expected
+
+    for executor in ["thread", "process"]:
+        result = md.markdown(
+            md_text,
+            extensions=['markdown_katex'],
+            extension_configs={'markdown_katex': {'max_workers': 4, 'executor': executor}},
+        )
+        assert result == expected
+
+
+def test_process_executor_config(tmpdir):
+    formulas = [("x^{%s}" % time.time(), None), ("y^{%s}" % time.time(), None)]
+    ext.formulas2html(formulas, max_workers=2, executor="process")
+    pool = ext._process_pools[2]
+
+    # the children of the pool (started before) use the new configuration
+    prev_config = (wrp.CACHE_BACKEND, wrp.CACHE_DIR, wrp.CACHE_MAX_AGE, wrp.CACHE_FAILURE_TTL)
+    try:
+        wrp.configure_cache(cache_dir=pl.Path(str(tmpdir)))
+        formulas = [("a^{%s}" % time.time(), None), ("b^{%s}" % time.time(), None)]
+        html_parts = ext.formulas2html(formulas, max_workers=2, executor="process")
+        assert html_parts == [markdown_katex.tex2html(tex) for tex, _ in formulas]
+        assert len(list(pl.Path(str(tmpdir)).glob("katex_*/*/*.html"))) == 2
+    finally:
+        wrp.configure_cache(*prev_config)
+
+    assert ext._process_pools[2] is pool
+
+
+def test_async_api():
+    async def _render_all():
+        return await asyncio.gather(
+            *(markdown_katex.tex2html_async(formula) for formula in markdown_katex.TEST_FORMULAS)
+        )
+
+    results = asyncio.run(_render_all())
+    assert results == [markdown_katex.tex2html(formula) for formula in markdown_katex.TEST_FORMULAS]
+
+    md_text = INLINE_MD_TMPL.format("$`" + BASIC_TEX + "`$", "$`" + TEX_WITH_SVG_OUTPUT + "`$")
+    config  = {
+        'extensions'       : ['markdown_katex'],
+        'extension_configs': {'markdown_katex': {'no_inline_svg': True}},
+    }
+    result = asyncio.run(markdown_katex.markdown_async(md_text, **config))
+    assert "md_katex" not in result
+    assert result == md.markdown(md_text, **config)
+
+
+def test_async_failure_cache(tmpdir, monkeypatch):
+    invalid_tex = r"e^{2 \pi i \xi x"
+    cleanups    = []
+    monkeypatch.setattr(wrp, '_cleanup_cache_dir', lambda: cleanups.append(1))
+
+    prev_config = (wrp.CACHE_BACKEND, wrp.CACHE_DIR, wrp.CACHE_MAX_AGE, wrp.CACHE_FAILURE_TTL)
+    markdown_katex.cache.MEMORY_CACHE.clear()
+    try:
+        wrp.configure_cache(cache_dir=pl.Path(str(tmpdir)), failure_ttl=600)
+        with pytest.raises(wrp.KatexError, match="ParseError"):
+            asyncio.run(markdown_katex.tex2html_async(invalid_tex))
+        assert len(cleanups) == 1
+
+        # same as tex2html: the failure is cached
+        markdown_katex.cache.MEMORY_CACHE.clear()
+        with pytest.raises(wrp.KatexError, match="ParseError"):
+            wrp._lookup_cached(wrp._cmd_digest(invalid_tex))
+
+        result = asyncio.run(markdown_katex.tex2html_async(BASIC_TEX, {'minify': True}))
+        assert result == markdown_katex.tex2html(BASIC_TEX, {'minify': True})
+        assert len(cleanups) == 2
+    finally:
+        markdown_katex.cache.MEMORY_CACHE.clear()
+        wrp.configure_cache(*prev_config)
+
+
+def test_bench_stub(capsys):
+    from markdown_katex import bench
+
+    assert bench.main(["--stub", "--formulas", "40", "--repeat", "2", "--json"]) == 0
+    report  = json.loads(capsys.readouterr().out)
+    results = {result['name']: result for result in report['results']}
+    assert report['meta']['stub'] is True
+    assert results['preprocessor_warm']['items'] == 40
+    assert results['tex2html_cold']['runs'] == 2
+    assert 'extension_init_lazy' in results
+
+    # not a multiple of the 4 formulas per paragraph
+    assert bench.main(["--stub", "--formulas", "10", "--repeat", "1", "--json"]) == 0
+    report  = json.loads(capsys.readouterr().out)
+    results = {result['name']: result for result in report['results']}
+    assert results['preprocessor_warm']['items'] == 10
+
+
+def test_postprocessor_markers(caplog):
+    katex_ext = ext.KatexExtension(insert_fonts_css=False)
+    postproc  = ext.KatexPostprocessor(md.Markdown(), katex_ext)
+
+    block_marker   = "tmp_block_md_katex_" + ext.make_marker_id("block")
+    inline_marker  = "tmp_inline_md_katex_" + ext.make_marker_id("inline")
+    missing_marker = "tmp_inline_md_katex_" + ext.make_marker_id("missing")
+    unknown_marker = "tmp_inline_md_katex_" + ext.make_marker_id("unknown")
+    postproc.state.math_html[block_marker]   = "<p><span>B</span></p>"
+    postproc.state.math_html[inline_marker]  = "<span>I</span>"
+    postproc.state.math_html[missing_marker] = "<span>M</span>"
+
+    text = (
+        f"<p>{block_marker}</p>\n<li>{block_marker}</li>\n"
+        + f"<p>{inline_marker}</p>\n<p>a {inline_marker} b {unknown_marker}</p>"
+    )
+    expected = (
+        "<p><span>B</span></p>\n<li><p><span>B</span></p></li>\n"
+        + f"<p><span>I</span></p>\n<p>a <span>I</span> b {unknown_marker}</p>"
+    )
+    assert postproc.run(text) == expected
+    assert "couldn't find: " + missing_marker in caplog.text
+    assert block_marker not in caplog.text
+
+    # hex characters directly after a marker are not part of it
+    text     = f"<p>value {inline_marker}abc and {inline_marker}12</p>"
+    expected = "<p>value <span>I</span>abc and <span>I</span>12</p>"
+    assert postproc.run(text) == expected
+
+    md_text = "value $`x`$abc and $`y`$12"
+    result  = md.markdown(md_text, extensions=[ext.KatexExtension()])
+    assert "tmp_inline_md_katex_" not in result
+    assert result.endswith("abc and " + ext.md_inline2html("$`y`$") + "12</p>")
+
+
+def test_svg2img_cached(katex_output, monkeypatch):
+    svg_count = katex_output.count("<svg")
+    assert svg_count > 1
+    assert ext.svg2img(katex_output * 3).count("<img") == svg_count * 3
+
+    options = {'no_inline_svg': True}
+    html_1  = ext.tex2html(TEX_WITH_SVG_OUTPUT, dict(options))
+    assert "<img" in html_1
+
+    def _svg2img(html):
+        raise AssertionError("no_inline_svg variant should have been cached")
+
+    monkeypatch.setattr(ext, 'svg2img', _svg2img)
+    assert ext.tex2html(TEX_WITH_SVG_OUTPUT, dict(options)) == html_1
+    markdown_katex.cache.MEMORY_CACHE.clear()
+    assert ext.formulas2html([(TEX_WITH_SVG_OUTPUT, options)]) == [html_1]
+
+
+def test_render_cli(tmpdir, capsys):
+    from markdown_katex import __main__ as cli
+
+    docs_dir = pl.Path(str(tmpdir)) / "docs"
+    (docs_dir / "sub").mkdir(parents=True)
+    (docs_dir / "index.md").write_text("# Index\n\n" + BASIC_BLOCK_TXT + "\n", encoding="utf-8")
+    page_text = "Inline $`a+b`$\n\n" + BASIC_BLOCK_TXT
+    (docs_dir / "sub" / "page.md").write_text(page_text, encoding="utf-8")
+
+    out_dir = pl.Path(str(tmpdir)) / "out"
+    assert cli.main(["render", str(docs_dir), "--output-dir", str(out_dir), "--jobs", "1"]) == 0
+    assert "Converted 2 of 2 files with 2 distinct formulas" in capsys.readouterr().out
+
+    index_html = (out_dir / "index.html").read_text(encoding="utf-8")
+    page_html  = (out_dir / "sub" / "page.html").read_text(encoding="utf-8")
+    assert ext.md_block2html(BASIC_BLOCK_TXT) in index_html
+    assert '<span class="katex">' in page_html
+    assert "md_katex" not in index_html + page_html
+
+
+def test_warm_cli(tmpdir, capsys, monkeypatch):
+    from markdown_katex import __main__ as cli
+
+    md_path = pl.Path(str(tmpdir)) / "warm.md"
+    md_text = "Inline $`a+b+c`$\n\n```math\n{\"trust\": true}\nx^{2}\n```\n\n" + BASIC_BLOCK_TXT
+    md_path.write_text(md_text, encoding="utf-8")
+
+    assert cli.main(["warm", str(md_path), "--jobs", "2"]) == 0
+    assert "Found 3 distinct formulas in 1 files" in capsys.readouterr().out
+
+    def _render_tex2html(*args):
+        raise AssertionError("formulas should have been cached")
+
+    monkeypatch.setattr(wrp, '_render_tex2html', _render_tex2html)
+    markdown_katex.cache.MEMORY_CACHE.clear()
+
+    assert cli.main(["warm", str(md_path)]) == 0
+    assert "3 were cached, rendered 0" in capsys.readouterr().out
+
+    result = md.markdown(md_text, extensions=['markdown_katex'])
+    assert result.count('<span class="katex-display">') == 2
+    assert "md_katex" not in result
+
+
+def test_metrics(caplog):
+    registry = markdown_katex.metrics.Metrics()
+    registry.inc('spawns', 2)
+    registry.observe('render_seconds', 0.003)
+    registry.observe('render_seconds', 20)
+
+    stats = registry.get_stats()
+    assert stats['spawns'] == 2
+    assert stats['memory_hits'] == 0
+    assert stats['render_seconds']['count'] == 2
+    assert stats['render_seconds']['buckets']["0.005"] == 1
+    assert stats['render_seconds']['buckets']["+Inf"] == 2
+
+    prom_text = registry.to_prometheus()
+    assert "# TYPE mdkatex_spawns_total counter\nmdkatex_spawns_total 2\n" in prom_text
+    assert 'mdkatex_render_seconds_bucket{le="+Inf"} 2\n' in prom_text
+    assert "mdkatex_render_seconds_count 2\n" in prom_text
+
+    tex = r"\sum_{i=0}^{n} i^{3} + " + str(time.time())
+    md_text   = "$`{0}`$ and $`{0}`$\n\n$`{0} + 1`$".format(tex)
+    katex_ext = ext.KatexExtension(log_stats=True)
+    with caplog.at_level("INFO", logger="markdown_katex.extension"):
+        md.markdown(md_text, extensions=[katex_ext])
+        md.markdown(md_text, extensions=[katex_ext])
+
+    ext_stats = katex_ext.get_stats()
+    assert ext_stats['renders'] == 2
+    assert ext_stats['memory_hits'] == 2
+    assert ext_stats['memory_misses'] == 2
+    assert ext_stats['render_seconds']['count'] == 2
+    assert katex_ext.conversion_metrics.get_stats()['renders'] == 0
+    assert "memory cache: 2 hits" in caplog.text
+
+    global_stats = markdown_katex.get_stats()
+    assert global_stats['renders'] >= ext_stats['renders']
+
+
+class RecordingTracer(markdown_katex.tracing.Tracer):
+    def __init__(self):
+        self.spans = []
+
+    def span(self, name, attributes):
+        self.spans.append((name, dict(attributes)))
+        return super().span(name, attributes)
+
+
+def test_tracing(monkeypatch, tmpdir):
+    tex     = r"\frac{a}{b} + " + str(time.time())
+    md_text = "$`{0}`$\n\n```math\n{0} + \\overbrace{{x}}^{{n}}\n```".format(tex)
+
+    tracer = RecordingTracer()
+    markdown_katex.tracing.set_tracer(tracer)
+    try:
+        md.markdown(md_text, extensions=[ext.KatexExtension(no_inline_svg=True)])
+    finally:
+        markdown_katex.tracing.set_tracer(None)
+
+    span_names = {name for name, _ in tracer.spans}
+    assert {
+        "mdkatex.preprocessor_scan",
+        "mdkatex.render_formulas",
+        "mdkatex.cache_lookup",
+        "mdkatex.katex_render",
+        "mdkatex.svg2img",
+        "mdkatex.cache_cleanup",
+        "mdkatex.postprocessor",
+    } <= span_names
+    render_texs = [attrs['tex'] for name, attrs in tracer.spans if name == "mdkatex.katex_render"]
+    assert tex in render_texs
+
+    # no spans are recorded after the tracer is reset
+    tracer.spans.clear()
+    md.markdown(md_text, extensions=[ext.KatexExtension()])
+    assert tracer.spans == []
+
+    report_path = tmpdir / "profile.txt"
+    monkeypatch.setattr(markdown_katex.tracing, 'PROFILE_ENV', str(report_path))
+    md.markdown(md_text.replace(tex, tex + "+ 1"), extensions=[ext.KatexExtension()])
+
+    report = report_path.read_text(encoding="utf-8")
+    assert report.startswith("markdown_katex profile of 2 formulas\n")
+    assert "mdkatex.katex_render" in report
+    assert "slowest 2 of 2 rendered formulas:" in report
+    assert tex + "+ 1" in report
+
+
+def _write_script(path, text):
+    path.write_text(textwrap.dedent(text).lstrip(), encoding="utf-8")
+    path.chmod(0o755)
+    return [str(path)]
+
+
+def test_render_timeout(monkeypatch, tmpdir):
+    tmp_dir   = pl.Path(str(tmpdir))
+    slow_cmd  = _write_script(tmp_dir / "slow_katex", "#!/bin/sh\nsleep 10\n")
+    noisy_cmd = _write_script(
+        tmp_dir / "noisy_katex",
+        """
+        #!/bin/sh
+        head -c 1000000 /dev/zero | tr '\\0' x >&2
+        exit 1
+        """,
+    )
+
+    monkeypatch.setattr(wrp, 'RENDER_TIMEOUT', 0.5)
+    for render in (wrp._pipe_tex2html, lambda cmd, tex: wrp._write_tex2html(cmd, tex, tmp_path)):
+        tmp_path = tmp_dir / "timeout_test.html"
+        t_start  = time.time()
+        with pytest.raises(wrp.KatexTimeoutError, match="timed out after 0.5s"):
+            render(list(slow_cmd), "x^2")
+        assert time.time() - t_start < 5
+
+        # a large error output doesn't block katex from exiting
+        with pytest.raises(wrp.KatexError) as excinfo:
+            render(list(noisy_cmd), "x^2")
+        assert not isinstance(excinfo.value, wrp.KatexTimeoutError)
+        assert len(str(excinfo.value)) > 1000000
+
+    assert sorted(path.name for path in tmp_dir.iterdir()) == ["noisy_katex", "slow_katex"]
+
+    # timeouts are not cached as failures
+    def _timeout_render(tex, options, digest):
+        raise wrp._timeout_error(tex)
+
+    monkeypatch.setattr(wrp, '_render_tex2html', _timeout_render)
+    tex = "x^{%s}" % time.time()
+    with pytest.raises(wrp.KatexTimeoutError):
+        wrp.tex2html(tex)
+    assert wrp._lookup_cached(wrp._cmd_digest(tex)) is None
+
+    results = wrp.tex2html_many([(tex, None), ("y" + tex, None)])
+    assert all(isinstance(result, wrp.KatexTimeoutError) for result in results)
+
+    wrp.set_render_timeout(None)
+    assert wrp.get_render_timeout() is None
+
+
+def test_dedup_math_html():
+    with (DATA_DIR / "katex_output.html").open(mode="r", encoding="utf-8") as fobj:
+        svg_html = fobj.read()
+
+    short_html = '<span class="katex">x</span>'
+    math_html  = {
+        'tmp_block_md_katex_aaaa' : "<p>" + svg_html + "</p>",
+        'tmp_inline_md_katex_bbbb': svg_html,
+        'tmp_inline_md_katex_cccc': short_html,
+    }
+    marker_counts = {
+        'tmp_block_md_katex_aaaa' : 1,
+        'tmp_inline_md_katex_bbbb': 3,
+        'tmp_inline_md_katex_cccc': 5,
+    }
+
+    result = ext.dedup_math_html(math_html, marker_counts)
+    assert result.head.startswith("<svg ")
+    assert result.head.count("<path id=") == svg_html.count("<path ")
+    assert result.tail == ""
+    for path_id in re.findall(r'<path id="([^"]+)"', result.head):
+        assert result.math_html['tmp_inline_md_katex_bbbb'].count(f'<use href="#{path_id}"/>') == 1
+    assert "<path " not in result.math_html['tmp_block_md_katex_aaaa']
+    assert result.math_html['tmp_inline_md_katex_cccc'] == short_html
+
+    # the page is smaller
+    orig_size  = sum(len(math_html[marker]) * count for marker, count in marker_counts.items())
+    dedup_size = len(result.head) + sum(
+        len(result.math_html[marker]) * count for marker, count in marker_counts.items()
+    )
+    assert dedup_size < orig_size
+
+    # a path that is only used once is left as it is
+    result = ext.dedup_math_html(math_html, {'tmp_inline_md_katex_bbbb': 1})
+    assert result.head == ""
+    assert result.math_html == math_html
+
+    result = ext.dedup_math_html(math_html, marker_counts, svg_paths=False, formulas=True)
+    assert result.head == ""
+    assert result.tail.count("<template ") == 1
+    assert result.tail.endswith("</script>")
+    assert result.math_html['tmp_inline_md_katex_bbbb'] == (
+        '<span class="mdkatex-use" data-template="mdkatex-f-bbbb"></span>'
+    )
+    assert result.math_html['tmp_block_md_katex_aaaa'] == math_html['tmp_block_md_katex_aaaa']
+
+    # paths in templates are only counted once
+    result = ext.dedup_math_html(math_html, marker_counts, svg_paths=True, formulas=True)
+    assert result.head.count("<path id=") == svg_html.count("<path ")
+    assert "<path " not in result.tail
+
+
+def test_dedup_formulas_extension():
+    tex     = r"\sum_{i=0}^{n} " + " + ".join(f"x_{{{i}}}^{{2}}" for i in range(20))
+    md_text = "$`{0}`$ and $`{0}`$\n\n$`{0}`$ and $`y`$".format(tex)
+
+    plain_html = md.markdown(md_text, extensions=[ext.KatexExtension()])
+    dedup_html = md.markdown(md_text, extensions=[ext.KatexExtension(dedup_formulas=True)])
+    assert len(dedup_html) < len(plain_html)
+    assert dedup_html.count('class="mdkatex-use"') == 3
+    assert dedup_html.count("<template ") == 1
+
+    # without repeated paths or formulas, the output is unchanged
+    md_text = "$`x`$ and $`y`$"
+    katex_ext = ext.KatexExtension(dedup_svg=True, dedup_formulas=True)
+    assert md.markdown(md_text, extensions=[katex_ext]) == md.markdown(
+        md_text, extensions=[ext.KatexExtension()]
+    )
+
+
+def test_output_format_and_minify(monkeypatch):
+    tex = r"\frac{1}{2}"
+    assert wrp._cmd_digest(tex, {'format': "htmlAndMathml"}) == wrp._cmd_digest(tex)
+    assert wrp._cmd_digest(tex, {'format': "html"}) != wrp._cmd_digest(tex)
+    assert wrp._cmd_digest(tex, {'format': "html"}) != wrp._cmd_digest(tex, {'format': "mathml"})
+    assert wrp._cmd_digest(tex, {'minify': True}) != wrp._cmd_digest(tex)
+
+    cmd_parts = list(wrp._iter_cmd_parts({'format': "html", 'minify': True}))
+    assert cmd_parts[-2:] == ["--format", "html"]
+    assert "--minify" not in cmd_parts
+    assert markdown_katex.worker.js_options({'format': "mathml", 'minify': True}) == {
+        'output': "mathml"
+    }
+
+    with (DATA_DIR / "katex_output.html").open(mode="r", encoding="utf-8") as fobj:
+        katex_output = fobj.read().strip()
+
+    minified = wrp.minify_html(katex_output)
+    assert len(minified) < len(katex_output)
+    assert ';"' not in minified
+    assert ":0." not in minified
+
+    orig_soup     = bs4.BeautifulSoup(katex_output, "html.parser")
+    minified_soup = bs4.BeautifulSoup(minified, "html.parser")
+    orig_tags     = [(tag.name, tag.get('class')) for tag in orig_soup.find_all(True)]
+    minified_tags = [(tag.name, tag.get('class')) for tag in minified_soup.find_all(True)]
+    assert orig_tags == minified_tags
+    # only whitespace between tags (e.g. around svgs) is removed
+    orig_texts     = [text for text in orig_soup.strings if text.strip()]
+    minified_texts = [text for text in minified_soup.strings if text.strip()]
+    assert orig_texts == minified_texts
+
+    # the minified output is cached
+    monkeypatch.setattr(wrp, '_render_tex2html', lambda tex, options, digest: katex_output)
+    tex = "x^{%s}" % time.time()
+    assert wrp.tex2html(tex, {'minify': True}) == minified
+    assert wrp.tex2html(tex) == katex_output
+
+    with pytest.raises(ValueError, match="Invalid format 'svg'"):
+        ext.KatexExtension(format="svg")
+
+
+def test_concurrent_conversions():
+    katex_ext = ext.KatexExtension(no_inline_svg=True)
+    options   = {'no_inline_svg': True, 'display-mode': True}
+    ext.tex2html(r"\frac{a}{b}", options)
+    assert options == {'no_inline_svg': True, 'display-mode': True}
+
+    with pytest.raises(TypeError):
+        katex_ext.options['display-mode'] = True
+
+    def _convert(i):
+        md_text = "Doc {0}: $`x_{{{0}}}`$\n\n```math\ny_{{{0}}} = \\utilde{{AB}}\n```\n".format(i)
+        return md.markdown(md_text, extensions=[katex_ext])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(_convert, range(64)))
+
+    for i, result in enumerate(results):
+        assert "Doc {0}:".format(i) in result
+        assert "x_{{{0}}}".format(i) in result
+        assert "tmp_inline_md_katex_" not in result
+        assert "tmp_block_md_katex_" not in result
+        other = (i + 1) % len(results)
+        assert "x_{{{0}}}".format(other) not in result
+        assert "<svg" not in result
+
+    # the last conversion of this thread
+    assert katex_ext.math_html == {}
+    _convert(0)
+    assert len(katex_ext.math_html) == 2